@@ -0,0 +1,314 @@
+"""
+Benchmarks for the music and games modules, run against synthetic libraries so that they work offline on any machine:
+
+    python benchmarks.py --scale 10k --games-scale 1k --save-baseline
+    python benchmarks.py --scale 10k --games-scale 1k
+
+The first run stores the timings in benchmarks_baseline.json; later runs report each timing against it and exit with an
+error if any is slower than the baseline by more than the tolerance.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+import music
+import games
+
+scales = {'1k': 1000, '10k': 10000, '100k': 100000, '1M': 1000000}
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks_baseline.json')
+
+# Two silent MPEG-1 layer III frames (128 kbps, 44.1 kHz); taglib wants a second frame to confirm the stream.
+mp3_frame = b'\xff\xfb\x90\x00' + bytes(413)
+id3_frames = {'ARTIST': b'TPE1', 'ALBUM': b'TALB', 'TITLE': b'TIT2'}
+
+
+def syncsafe(n: int):
+    return bytes([(n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f])
+
+
+def id3_tag(tags: dict):
+    """
+    Builds an ID3v2.3 tag holding UTF-16 text frames for the given ARTIST, ALBUM and TITLE.
+    """
+    frames = b''
+    for tag, value in tags.items():
+        data = b'\x01' + value.encode('utf-16')
+        frames += id3_frames[tag] + struct.pack('>I', len(data)) + b'\x00\x00' + data
+    return b'ID3\x03\x00\x00' + syncsafe(len(frames)) + frames
+
+
+def stub_read_tags(path: str, is_csv: bool = False, full: bool = False):
+    """
+    Stand-in for music.read_tags that parses the tags written by id3_tag itself, for machines without pytaglib.
+    """
+    if is_csv:
+        return music.read_tags(path, is_csv=True)
+    with open(path, 'rb') as file:
+        header = file.read(10)
+        size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        data = file.read(size)
+    names = {frame: tag for tag, frame in id3_frames.items()}
+    tags = {}
+    position = 0
+    while position + 10 <= len(data):
+        frame = data[position:position + 4]
+        length = struct.unpack('>I', data[position + 4:position + 8])[0]
+        if frame in names:
+            tags[names[frame]] = [data[position + 11:position + 10 + length].decode('utf-16')]
+        position += 10 + length
+    return tags
+
+
+def make_music_library(root: str, tracks: int, tracks_per_album: int = 12, albums_per_artist: int = 4, seed: int = 0):
+    """
+    Writes a synthetic library of tagged MP3s, laid out as artist/album/track.
+    """
+    rng = random.Random(seed)
+    for i in range(tracks):
+        album_number = i // tracks_per_album
+        artist = f"Artist {album_number // albums_per_artist}"
+        album = f"Album {album_number}"
+        directory = os.path.join(root, artist, album)
+        if i % tracks_per_album == 0:
+            os.makedirs(directory, exist_ok=True)
+        title = f"Song {i} {rng.choice(['Love', 'Night', 'Road', 'Fire', 'Rain'])}"
+        with open(os.path.join(directory, f"{i % tracks_per_album:02d} {title}.mp3"), 'wb') as file:
+            file.write(id3_tag({'ARTIST': artist, 'ALBUM': album, 'TITLE': title}))
+            file.write(mp3_frame * 2)
+
+
+game_columns = ['Title', 'Instance Of', 'Platform', 'Format', 'Series', 'Series #', 'Developer', 'Publisher',
+                'Local Players', 'Online Players', 'Release Date', 'Obtained', 'Completion', 'Metacritic',
+                'GameRankings', 'My Rating', 'Condition', 'Box', 'Manual', 'Other', 'GB Notes', 'Key', 'Generation']
+platforms = ['PC', 'PS2', 'PS3', 'PS4', 'Xbox 360', 'Wii', 'Switch', 'GameCube', 'DS', '3DS']
+formats = ['Disc', 'Cartridge', 'Digital']
+completions = ['Unplayed', 'Played', 'Finished', 'Complete']
+
+
+def make_game_rows(games_count: int, seed: int = 0):
+    """
+    Synthetic rows in the layout of the Games Library spreadsheet: each game may be followed by '   + ' DLC rows and
+    '   ^ ' included-game rows. Distinct titles grow with the number of games, as in a real catalogue.
+    """
+    rng = random.Random(seed)
+    nan = float('nan')
+    rows = []
+    for i in range(games_count):
+        title = f"Game {rng.randrange(max(1, games_count * 3 // 4))}"
+        series = f"Series {rng.randrange(max(1, games_count // 10))}" if rng.random() < 0.6 else nan
+        row = [title, title, rng.choice(platforms), rng.choice(formats), series, rng.randrange(1, 6) if series == series
+               else nan, f"Developer {rng.randrange(200)}", f"Publisher {rng.randrange(50)}", rng.randrange(1, 5),
+               nan, f"{rng.randrange(1990, 2024)}", f"{rng.randrange(2000, 2024)}", rng.choice(completions),
+               rng.choice([nan, rng.randrange(40, 100)]), rng.choice([nan, rng.randrange(40, 100)]),
+               rng.choice([nan, rng.randrange(1, 11)]), rng.choice(['New', 'Used', nan]), rng.choice(['Y', 'N']),
+               rng.choice(['Y', 'N']), nan, nan, nan, float(rng.randrange(3, 10))]
+        rows.append(row)
+        for j in range(rng.choice([0, 0, 0, 1, 2])):
+            dlc = list(row)
+            dlc[0] = f"   + {title} DLC {j}"
+            dlc[1] = nan
+            rows.append(dlc)
+        if rng.random() < 0.05:
+            include = list(row)
+            include[0] = f"   ^ Game {rng.randrange(max(1, games_count))}"
+            include[1] = include[0][6:]
+            rows.append(include)
+    return rows
+
+
+def make_games_spreadsheet(path: str, games_count: int, seed: int = 0):
+    """
+    Writes a synthetic Games Library workbook; the first four rows below the header are left blank, as
+    GameLibrary.import_from_xl skips them.
+    """
+    import pandas as pd
+    rows = [[None] * len(game_columns)] * 4 + make_game_rows(games_count, seed=seed)
+    pd.DataFrame(rows, columns=game_columns).to_excel(path, index=False)
+
+
+def make_game_library(games_count: int, seed: int = 0):
+    """
+    Builds a GameLibrary straight from synthetic rows, for timing the statistics without reading a workbook.
+    """
+    import pandas as pd
+    library = games.GameLibrary()
+    library.import_from_frame(pd.DataFrame(make_game_rows(games_count, seed=seed), columns=game_columns))
+    return library
+
+
+class Benchmark:
+    def __init__(self, repeat: int = 3):
+        self.repeat = repeat
+        self.results = {}
+        self.errors = {}
+
+    def time(self, name: str, function, setup=None):
+        """
+        Runs function repeat times, calling setup before each run, and records the fastest run; anything printed is
+        discarded. A failure is recorded rather than raised, so that the other benchmarks still run.
+        """
+        best = None
+        for i in range(self.repeat):
+            argument = setup() if setup is not None else None
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    if setup is not None:
+                        function(argument)
+                    else:
+                        function()
+                    elapsed = time.perf_counter() - start
+            except Exception as e:
+                self.errors[name] = f"{type(e).__name__}: {e}"
+                print(f"{name:<48} failed: {self.errors[name]}")
+                return
+            if best is None or elapsed < best:
+                best = elapsed
+        self.results[name] = best
+        print(f"{name:<48} {best:10.4f} s")
+
+    def compare(self, baseline: dict, tolerance: float = 0.2):
+        """
+        Prints each timing beside its baseline, followed by any benchmarks that failed.
+
+        :return: The names of the benchmarks slower than baseline by more than tolerance (a fraction).
+        """
+        regressions = []
+        print()
+        print(f"{'Benchmark':<48} {'Time':>10} {'Baseline':>10} {'Ratio':>7}")
+        for name, elapsed in self.results.items():
+            before = baseline.get(name)
+            if before is None:
+                print(f"{name:<48} {elapsed:10.4f} {'-':>10} {'-':>7}")
+                continue
+            ratio = elapsed / before if before > 0 else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+                flag = '  REGRESSION'
+            print(f"{name:<48} {elapsed:10.4f} {before:10.4f} {ratio:7.2f}{flag}")
+        for name, error in self.errors.items():
+            print(f"{name:<48} {'FAILED':>10} {'-':>10} {'-':>7}  {error}")
+        return regressions
+
+
+def run_music(benchmark: Benchmark, tracks: int, workdir: str, workers: int):
+    root = os.path.join(workdir, 'music')
+    start = time.perf_counter()
+    make_music_library(root, tracks)
+    print(f"Generated {tracks} tracks in {time.perf_counter() - start:.1f} s")
+    scale = f"[{tracks}]"
+
+    benchmark.time(f"SongDictTree.populate {scale}",
+                   lambda: music.SongDictTree(root, library_type='itunes'))
+    benchmark.time(f"SongDictTree.populate workers={workers} {scale}",
+                   lambda: music.SongDictTree(root, library_type='itunes', workers=workers))
+
+    tree = music.SongDictTree(root, library_type='itunes')
+    other = music.SongDictTree.load_snapshot(save_snapshot(tree, workdir))
+    for i, artist in enumerate(list(other.artists)):
+        if i % 10 == 0:
+            del other.artists[artist]
+    other.count_songs()
+    benchmark.time(f"SongDictTree.compare {scale}", lambda: tree.compare(other))
+    benchmark.time(f"SongDictTree.compare normalised {scale}", lambda: tree.compare(other, match='normalised'))
+    benchmark.time(f"SongDictTree.write_csv {scale}", lambda: tree.write_csv(os.path.join(workdir, 'library')))
+    snapshot = save_snapshot(tree, workdir)
+    benchmark.time(f"SongDictTree.load_snapshot {scale}", lambda: music.SongDictTree.load_snapshot(snapshot))
+
+
+def save_snapshot(tree: 'music.SongDictTree', workdir: str):
+    path = os.path.join(workdir, 'library.snapshot')
+    tree.save_snapshot(path)
+    return path
+
+
+def run_games(benchmark: Benchmark, games_count: int, workdir: str):
+    scale = f"[{games_count}]"
+    path = os.path.join(workdir, 'Games Library.xlsx')
+    make_games_spreadsheet(path, games_count)
+    benchmark.time(f"GameLibrary.import_from_xl {scale}", lambda: games.GameLibrary(path))
+    games.GameLibrary(path, cache=True)
+    benchmark.time(f"GameLibrary.import_from_xl cached {scale}", lambda: games.GameLibrary(path, cache=True))
+    benchmark.time(f"GameLibrary.import_from_stream {scale}", lambda: games.GameLibrary().import_from_stream(path))
+
+    library = make_game_library(games_count)
+    # The statistics are cached, so each run starts from an invalidated library to time the pass as well.
+    for method in ['count_unique', 'most_owned', 'most_owned_series', 'count_libraries', 'count_formats',
+                   'completion_stats', 'rating_by_series']:
+        benchmark.time(f"GameLibrary.{method} {scale}", lambda _, method=method: getattr(library, method)(),
+                       setup=library.invalidate)
+    benchmark.time(f"GameLibrary.show top 20 metacritic {scale}",
+                   lambda fresh: fresh.show('metacritic', num=20, reverse=True),
+                   setup=lambda: make_game_library(games_count))
+    benchmark.time(f"GameLibrary.show title {scale}", lambda: library.show('title', dlc=True))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=list(scales), default='1k', help="Number of tracks in the music library.")
+    parser.add_argument('--games-scale', choices=list(scales), default='1k', help="Number of games in the catalogue.")
+    parser.add_argument('--only', choices=['music', 'games'], help="Only run one module's benchmarks.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each benchmark; the fastest is kept.")
+    parser.add_argument('--workers', type=int, default=4, help="Workers for the parallel scan.")
+    parser.add_argument('--stub-tags', action='store_true',
+                        help="Read tags with a built-in ID3 parser instead of pytaglib.")
+    parser.add_argument('--baseline', default=default_baseline, help="Baseline file to compare with or save to.")
+    parser.add_argument('--save-baseline', action='store_true', help="Store these timings as the new baseline.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown before a regression.")
+    parser.add_argument('--keep', action='store_true', help="Keep the generated libraries.")
+    args = parser.parse_args(args)
+
+    if args.stub_tags or music.tl is None:
+        print("Using the stub tag reader.")
+        music.read_tags = stub_read_tags
+    music.set_verbosity(0)
+
+    benchmark = Benchmark(repeat=args.repeat)
+    status = 0
+    workdir = tempfile.mkdtemp(prefix='pylibraries_bench_')
+    try:
+        if args.only in (None, 'music'):
+            run_music(benchmark, scales[args.scale], workdir, workers=args.workers)
+        if args.only in (None, 'games'):
+            run_games(benchmark, scales[args.games_scale], workdir)
+    finally:
+        if args.keep:
+            print("Generated files kept in", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        baseline.update(benchmark.results)
+        with open(args.baseline, 'w') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        print("Saved baseline to", args.baseline)
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            regressions = benchmark.compare(json.load(file), tolerance=args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions.")
+            status = 1
+    if benchmark.errors:
+        print(f"{len(benchmark.errors)} benchmarks failed:")
+        for name, error in benchmark.errors.items():
+            print(f"  {name}: {error}")
+        status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,101 +1,60 @@
+import gc
+import heapq
+import os
+import json
+import numpy as np
 import pandas as pd
-
-
-# TODO: Average rating by series
-
-class GameLibrary:
-    def __init__(self, path=None):
-        self.games = list()
-
-        self.unique_game_count = 0
-        self.unique_dlc_count = 0
-
-        if path is not None:
-            self.import_from_xl(path)
-
-    def __getitem__(self, item):
-        return self.games[item]
-
-    def show(self, sort='title', dlc=False, unique=True):
-
-        if sort == 'title':
-            self.games.sort(key=lambda g: g.title.lower())
-
-            for g in self:
-                print(g.title)
-
-                if dlc:
-                    for i in g.includes:
-                        print('    Includes: ' + i.title)
-                    for d in g.dlc:
-                        print('    DLC: ' + d.title)
-
-        if sort == 'developer':
-
-            self.games.sort(key=lambda g: g.developer)
-
-            for g in self.games:
-                print(g.title + ': ' + str(g.developer.lower()))
-
-                if dlc:
-                    for i in g.includes:
-                        print('    Includes: ' + i.title)
-                    for d in g.dlc:
-                        print('    DLC: ' + d.title)
-
-        if sort == 'metacritic':
-
-            self.games.sort(key=lambda g: g.metacritic)
-
-            for g in self.games:
-                print(g.title + ': ' + str(g.metacritic))
-
-                if dlc:
-                    for i in g.includes:
-                        print('    Includes: ' + i.title + ': ' + i.metacritic)
-                    for d in g.dlc:
-                        print('    DLC: ' + d.title + ': ' + d.metacritic)
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from operator import attrgetter
+
+from utils import file_hash
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+sheet_cache_version = 4
+# Fields GameLibrary.index keeps a value: positions map for, and fields it keeps a sorted index for range queries on
+indexed_fields = ('platform', 'series', 'developer', 'completion', 'generation')
+sorted_fields = ('metacritic', 'gamerankings', 'my_rating', 'generation')
+# Sorts GameLibrary.show knows: (sort key, line for a game, line for an included game or DLC)
+show_sorts = {
+    'title': (lambda g: g.title.lower(), lambda g: g.title, lambda g: g.title),
+    'developer': (lambda g: g.developer, lambda g: g.title + ': ' + str(g.developer.lower()), lambda g: g.title),
+    'metacritic': (lambda g: g.metacritic, lambda g: g.title + ': ' + str(g.metacritic),
+                   lambda g: g.title + ': ' + str(g.metacritic)),
+}
+
+
+class LibraryReports:
+    '''
+    The reports on a LibraryStats, shared by GameLibrary and LibraryMerge, which provide it as stats.
+    '''
+    @property
+    def unique_game_count(self):
+        return len(self.stats.games)
+
+    @property
+    def unique_dlc_count(self):
+        return len(self.stats.dlcs)
 
     def count_unique(self):
         '''
-        :param num:
-        :return:
+        Counts the unique games (including included games) and unique DLC.
+        :return: List of TitleNum for each unique DLC.
         '''
 
-        games = list()
-        dlcs = list()
-
-        for game in self:
-
-            g = TitleNum(game.instance_of, 0)
-
-            if g.title != 'nan':
-
-                if g not in games:
-                    games.append(g)
-                    self.unique_game_count += 1
-
-                if game.dlc:
-
-                    for dlc in game.dlc:
-                        d = TitleNum(dlc.title, 1)
-
-                        if d not in dlcs and d.title != 'nan':
-                            dlcs.append(d)
-                            self.unique_dlc_count += 1
-
-                if game.includes:
-
-                    for include in game.includes:
-                        inc = TitleNum(include.instance_of, 1)
-
-                        if inc not in games:
-                            games.append(inc)
-                            self.unique_game_count += 1
-
         print('Number of Unique Games: ' + str(self.unique_game_count))
         print('Number of Unique DLCs: ' + str(self.unique_dlc_count))
-        return dlcs
+        return list(self.stats.dlcs.values())
 
     def most_owned_series(self, num=10):
         '''
@@ -104,27 +63,7 @@ class GameLibrary:
         :return:
         '''
 
-        games = list()
-
-        for game in self:
-
-            g = TitleNum(game.series, 1)
-
-            if g.title != 'nan':
-
-                if g not in games:
-                    games.append(g)
-
-                else:
-                    i = games.index(g)
-                    games[i].increment()
-
-        games.sort(key=lambda t: t.num, reverse=True)
-
-        for i in range(num):
-            print(str(i) + '. ' + str(games[i].title) + ' (' + str(games[i].num) + ')')
-
-        print()
+        show_counts(rank_counts(self.stats.series)[:num])
 
     def most_owned(self, num=10):
         '''
@@ -133,284 +72,585 @@ class GameLibrary:
         :return:
         '''
 
-        games = list()
-
-        for game in self:
-
-            g = TitleNum(game.instance_of, 1)
-
-            # Don't count the nans
-            if g.title != 'nan':
-
-                if g not in games:
-                    games.append(g)
-
-                else:
-                    i = games.index(g)
-                    games[i].increment()
-
-                if game.dlc:
+        show_counts(rank_counts(self.stats.owned)[:num])
 
-                    for dlc in game.dlc:
-                        d = TitleNum(dlc.instance_of, 1)
+    def count_libraries(self):
+        show_counts(rank_counts(self.stats.platforms))
 
-                        if d.title != 'nan':
+    def count_formats(self):
+        show_counts(rank_counts(self.stats.formats))
 
-                            if d not in games:
-                                games.append(d)
+    def completion_stats(self):
+        completion_levels = rank_counts(self.stats.completion)
+        unique_game_count = self.unique_game_count
 
-                            else:
-                                i = games.index(d)
-                                games[i].increment()
+        for i, c in enumerate(completion_levels):
+            percent = 100 * (c.num / unique_game_count) if unique_game_count else 0.0
+            print(str(i) + ". " + str(c.title) + " (" + str(c.num) + ")" + "[" + str(percent) + "%]")
 
-                if game.includes:
+        print()
 
-                    for include in game.includes:
-                        inc = TitleNum(include.instance_of, 1)
+    def rating_by_series(self, num=None):
+        '''
+        Average of my ratings for each series, highest first. Does not count DLC or included games, or unrated games.
+        :param num: Number of series to show, or None for all of them.
+        :return:
+        '''
 
-                        if inc.title != 'nan':
+        ratings = self.stats.average_ratings()
 
-                            if inc not in games:
-                                games.append(inc)
+        for i, (series, average, count) in enumerate(ratings[:num]):
+            print(str(i) + ". " + series + ": " + str(round(average, 2)) + " (" + str(count) + ")")
 
-                            else:
-                                i = games.index(inc)
-                                games[i].increment()
+        print()
 
-        games.sort(key=lambda t: t.num, reverse=True)
 
-        for i in range(num):
-            print(str(i) + '. ' + str(games[i].title) + ' (' + str(games[i].num) + ')')
+class GameLibrary(LibraryReports):
+    def __init__(self, path=None, cache=False):
+        self.games = GameList()
 
-        print()
+        if path is not None:
+            self.import_from_xl(path, cache=cache)
 
-    def count_libraries(self):
-        libraries = list()
+    def __getitem__(self, item):
+        return self.games[item]
 
-        for game in self:
-            l = TitleNum(game.platform, 1)
+    @property
+    def games(self):
+        return self._games
 
-            # Don't count the nans
-            if l.title != 'nan':
+    @games.setter
+    def games(self, games):
+        self._games = games if isinstance(games, GameList) else GameList(games)
+        self.invalidate()
 
-                if l not in libraries:
-                    libraries.append(l)
+    def invalidate(self):
+        '''
+        Drops the statistics and indexes, which only notice changes to the games list itself; call this after changing
+        games in place.
+        '''
+        self._stats = None
+        self._stats_layout = None
+        self._stats_length = 0
+        self._indexes = dict()
+        self._sorted_indexes = dict()
+        self._orders = dict()
+        self._index_layout = self._games.layout
+
+    @property
+    def stats(self):
+        '''
+        All the counts behind the reports, gathered in one pass over the games. Games appended later are added to it;
+        any other change to the games list means a new pass.
+        '''
+        games = self.games
+        if self._stats is None or self._stats_layout != games.layout or self._stats_length > len(games):
+            self._stats = LibraryStats()
+            self._stats_layout = games.layout
+            self._stats_length = 0
+        for i in range(self._stats_length, len(games)):
+            self._stats.add(games[i])
+        self._stats_length = len(games)
+        return self._stats
+
+    def _check_indexes(self):
+        if self._index_layout != self.games.layout:
+            self._indexes.clear()
+            self._sorted_indexes.clear()
+            self._orders.clear()
+            self._index_layout = self.games.layout
+
+    def index(self, field):
+        '''
+        Positions in games of the games with each value of field, built the first time it is asked for and kept up to
+        date as games are appended.
+        :param field: Game attribute, usually one of indexed_fields.
+        :return: Dictionary of value: list of positions, in order.
+        '''
+        self._check_indexes()
+        entry = self._indexes.get(field)
+        if entry is None:
+            entry = self._indexes[field] = [0, dict()]
+        games = self.games
+        if entry[0] < len(games):
+            index = entry[1]
+            for position in range(entry[0], len(games)):
+                index.setdefault(getattr(games[position], field), []).append(position)
+            entry[0] = len(games)
+        return entry[1]
+
+    def sorted_index(self, field):
+        '''
+        Values of a numeric field in ascending order, with the position in games of the game each came from. Games
+        without a value (nan) are left out.
+        :param field: Game attribute, usually one of sorted_fields.
+        :return: Tuple of (list of values, list of positions).
+        '''
+        self._check_indexes()
+        entry = self._sorted_indexes.get(field)
+        games = self.games
+        if entry is None or len(games) - entry[0] > len(entry[1]) // 8:
+            # Building from scratch is cheaper than inserting more than a few games one by one
+            pairs = [(value, position) for position, value in enumerate(map(attrgetter(field), games))
+                     if value == value]
+            pairs.sort()
+            entry = self._sorted_indexes[field] = [len(games), [p[0] for p in pairs], [p[1] for p in pairs]]
+        elif entry[0] < len(games):
+            values, positions = entry[1], entry[2]
+            for position in range(entry[0], len(games)):
+                value = getattr(games[position], field)
+                if value == value:
+                    i = bisect_right(values, value)
+                    values.insert(i, value)
+                    positions.insert(i, position)
+            entry[0] = len(games)
+        return entry[1], entry[2]
+
+    def query(self):
+        '''
+        Starts a query over the games, eg
+        library.query().where(platform='PC', completion='Unplayed').range('metacritic', 80).sort('metacritic',
+        reverse=True).limit(10).games()
+        :return: A GameQuery.
+        '''
+        return GameQuery(self)
 
-                else:
-                    i = libraries.index(l)
-                    libraries[i].increment()
+    def sort_order(self, sort='title', reverse=False):
+        '''
+        Positions in games of the games in the order show lists them, computed once per sort and kept while games are
+        only appended; new games are sorted on their own and merged in.
+        :param sort: One of show_sorts.
+        :param reverse: Descending order; games that compare equal stay in library order.
+        :return: List of positions.
+        '''
+        self._check_indexes()
+        key = show_sorts[sort][0]
+        games = self.games
+        entry = self._orders.get((sort, reverse))
+        if entry is None:
+            positions = sorted(range(len(games)), key=lambda p: key(games[p]), reverse=reverse)
+            entry = self._orders[(sort, reverse)] = [len(games), positions]
+        elif entry[0] < len(games):
+            new = sorted(range(entry[0], len(games)), key=lambda p: key(games[p]), reverse=reverse)
+            entry[1] = list(heapq.merge(entry[1], new, key=lambda p: key(games[p]), reverse=reverse))
+            entry[0] = len(games)
+        return entry[1]
+
+    def show(self, sort='title', dlc=False, unique=True, num=None, page=None, page_size=50, reverse=False, file=None):
+        '''
+        Lists the games sorted by title, developer or metacritic, without reordering the library itself.
+        :param sort: One of show_sorts.
+        :param dlc: Whether to list each game's included games and DLC under it.
+        :param num: Only list the first num games; without a cached order these are found with a heap instead of a
+        full sort.
+        :param page: Only list this page, counting from 0, of page_size games.
+        :param reverse: Descending order.
+        :param file: Path or stream to write to instead of stdout.
+        :return:
+        '''
 
-        libraries.sort(key=lambda lib: lib.num, reverse=True)
+        if sort not in show_sorts:
+            raise ValueError('Sort not recognised')
+
+        if isinstance(file, str):
+            with open(file, 'w', encoding='utf-8') as stream:
+                return self.show(sort, dlc, unique, num, page, page_size, reverse, stream)
+
+        key, line, child_line = show_sorts[sort]
+        games = self.games
+
+        if page is not None:
+            positions = self.sort_order(sort, reverse)[page * page_size:(page + 1) * page_size]
+            if num is not None:
+                positions = positions[:num]
+        elif num is not None:
+            self._check_indexes()
+            if (sort, reverse) in self._orders:
+                positions = self.sort_order(sort, reverse)[:num]
+            else:
+                # Both are equivalent to sorted(...)[:num], ties included
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                positions = select(num, range(len(games)), key=lambda p: key(games[p]))
+        else:
+            positions = self.sort_order(sort, reverse)
 
-        for i, l in enumerate(libraries):
-            print(str(i) + ". " + str(l.title) + " (" + str(l.num) + ")")
-        print()
+        for p in positions:
+            g = games[p]
+            print(line(g), file=file)
 
-    def count_formats(self):
-        formats = list()
+            if dlc:
+                for i in g.includes:
+                    print('    Includes: ' + child_line(i), file=file)
+                for d in g.dlc:
+                    print('    DLC: ' + child_line(d), file=file)
 
-        for game in self:
-            f = TitleNum(game.formats, 1)
+    def import_from_xl(self, path="C:\\Users\\Lachlan\\Google Drive\\Projects\\Python\\libraries\\Games Library.xlsx",
+                       cache=False):
+        '''
+        :param path: Path to the Games Library workbook.
+        :param cache: Whether to keep the parsed sheet in a sidecar file next to the workbook and read it from there
+        while the workbook is unchanged; needs pyarrow.
+        :return: List of the games added.
+        '''
+        return self.import_columns(read_sheet(path, cache=cache))
 
-            # Don't count the nans
-            if f.title != 'nan':
+    def import_from_frame(self, lib):
+        '''
+        Adds the games in a DataFrame laid out like the Games Library sheet. Rows whose title contains ' + ' are DLC and
+        rows containing ' ^ ' are games included with the game above them.
+        :param lib: DataFrame with the columns of the sheet, in order.
+        :return: List of the games added.
+        '''
+        return self.import_columns(read_columns(lib))
 
-                if f not in formats:
-                    formats.append(f)
+    def import_columns(self, columns):
+        '''
+        :param columns: Dictionary of Game attribute: Series, as from read_columns.
+        :return: List of the games added.
+        '''
+        games = build_games(columns)[0]
+        self.games.extend(games)
+        return games
 
-                else:
-                    i = formats.index(f)
-                    formats[i].increment()
+    def import_from_stream(self, path, chunk_size=10000):
+        '''
+        Adds the games from a Games Library workbook or csv export of it, a chunk of rows at a time, so that the sheet
+        is never in memory as a whole. The statistics and indexes take in each chunk as it is added.
+        :param path: Path to the .xlsx or .csv file.
+        :param chunk_size: Number of rows to read at a time.
+        :return: The number of games added.
+        '''
+        count = 0
+        for games in stream_games(path, chunk_size=chunk_size, batches=True):
+            self.games.extend(games)
+            count += len(games)
+        return count
 
-        formats.sort(key=lambda lib: lib.num, reverse=True)
 
-        for i, f in enumerate(formats):
-            print(str(i) + ". " + str(f.title) + " (" + str(f.num) + ")")
-        print()
+# Shared by every game without DLC or includes; only ever sliced, never changed
+no_children = []
 
-    def completion_stats(self):
-        completion_levels = list()
 
-        for game in self:
-            c = TitleNum(game.completion, 1)
+class Game:
+    '''
+    A game, DLC or included game. DLC and included games are kept as ranges of a list of children, which is shared by
+    all the games imported together, rather than as two lists per game.
+    '''
+    __slots__ = ('title', 'instance_of', 'platform', 'formats', 'series', 'series_num', 'developer', 'publisher',
+                 'local_players', 'online_players', 'release_date', 'obtained', 'completion', 'metacritic',
+                 'gamerankings', 'my_rating', 'condition', 'box', 'manual', 'other', 'gb_notes', 'key', 'generation',
+                 '_children', '_dlc_start', '_dlc_stop', '_include_start', '_include_stop')
+
+    def __init__(self, title='', instance_of='', platform='', formats='', series='', series_num='', developer='',
+                 publisher='', local_players='', online_players='', release_date='', obtained='', completion='',
+                 metacritic=0.0, gamerankings=0.0, my_rating=0.0, condition='', box=False, manual=False, other='',
+                 gb_notes='', key='', generation=0.0):
+        self.title = title
+        self.instance_of = instance_of
+        self.platform = platform
+        self.formats = formats
+        self.series = series
+        self.series_num = series_num
+        self.developer = developer
+        self.publisher = publisher
+        self.local_players = local_players
+        self.online_players = online_players
+        self.release_date = release_date
+        self.obtained = obtained
+        self.completion = completion
+        self.metacritic = metacritic
+        self.gamerankings = gamerankings
+        self.my_rating = my_rating
+        self.condition = condition
+        self.box = box
+        self.manual = manual
+        self.other = other
+        self.gb_notes = gb_notes
+        self.key = key
+        self.generation = generation
+        self._children = no_children
+        self._dlc_start = self._dlc_stop = self._include_start = self._include_stop = 0
+
+    @property
+    def dlc(self):
+        '''
+        A tuple of the game's DLC; assign to this, or use add_dlc, to change them.
+        '''
+        return tuple(self._children[self._dlc_start:self._dlc_stop])
 
-            # Don't count the nans
-            if c.title != 'nan':
+    @dlc.setter
+    def dlc(self, dlc):
+        self.set_children(dlc, self.includes)
 
-                if c not in completion_levels:
-                    completion_levels.append(c)
+    @property
+    def includes(self):
+        '''
+        A tuple of the games included with this one; assign to this, or use add_include, to change them.
+        '''
+        return tuple(self._children[self._include_start:self._include_stop])
 
-                else:
-                    i = completion_levels.index(c)
-                    completion_levels[i].increment()
+    @includes.setter
+    def includes(self, includes):
+        self.set_children(self.dlc, includes)
 
-        completion_levels.sort(key=lambda lib: lib.num, reverse=True)
+    def add_dlc(self, dlc):
+        self.set_children(self.dlc + (dlc,), self.includes)
 
-        for i, c in enumerate(completion_levels):
-            percent = 100 * (c.num / self.unique_game_count)
-            print(str(i) + ". " + str(c.title) + " (" + str(c.num) + ")" + "[" + str(percent) + "%]")
+    def add_include(self, include):
+        self.set_children(self.dlc, self.includes + (include,))
 
-        print()
+    def set_children(self, dlc, includes, children=None, dlc_start=0, include_start=None):
+        '''
+        Points the game at its DLC and included games. Given children, the DLC are children[dlc_start:dlc_start +
+        len(dlc)] and the includes follow from include_start, so several games can share one list; otherwise the game
+        gets a list of its own.
+        '''
+        if children is None:
+            children = list(dlc) + list(includes)
+            dlc_start = 0
+            include_start = len(dlc)
+        self._children = children
+        self._dlc_start = dlc_start
+        self._dlc_stop = dlc_start + len(dlc)
+        self._include_start = include_start
+        self._include_stop = include_start + len(includes)
+
+
+game_fields = ['title', 'instance_of', 'platform', 'formats', 'series', 'series_num', 'developer', 'publisher',
+               'local_players', 'online_players', 'release_date', 'obtained', 'completion', 'metacritic',
+               'gamerankings', 'my_rating', 'condition', 'box', 'manual', 'other', 'gb_notes', 'key', 'generation']
+
+
+def read_columns(lib):
+    '''
+    Converts each column of the sheet to the type Game keeps it as.
+    :param lib: DataFrame with the columns of the sheet, in order.
+    :return: Dictionary of Game attribute: Series.
+    '''
+    columns = dict()
+    for i, field in enumerate(game_fields):
+        column = lib.iloc[:, i]
+        if field in ('box', 'manual'):
+            columns[field] = column == 'Y'
+        elif field in ('metacritic', 'gamerankings', 'my_rating', 'generation'):
+            columns[field] = pd.to_numeric(column, errors='coerce').astype(float)
+        elif pd.api.types.is_string_dtype(column) and not pd.api.types.is_object_dtype(column):
+            columns[field] = column.astype(object).fillna('nan')
+        elif pd.api.types.is_float_dtype(column) or pd.api.types.is_object_dtype(column):
+            # Whether a column of whole numbers reads as floats depends on whether it has blanks, which varies between
+            # chunks, so whole numbers are always written without the '.0'
+            columns[field] = column.map(to_text)
+        else:
+            # map(str) rather than astype(str), which leaves nans as they are in newer pandas
+            columns[field] = column.map(str)
+
+    columns['metacritic'] = columns['metacritic'].fillna(0.0)
+    return columns
+
+
+def read_sheet(path, cache=False):
+    '''
+    Reads the Games Library workbook into columns, as read_columns does. With cache, and pyarrow installed, the columns
+    are also written to a Feather sidecar next to the workbook, keyed on the workbook's modification time, size and
+    hash, and later reads load the sidecar instead while the workbook is unchanged.
+    :param path: Path to the workbook.
+    :param cache: Whether to use and update the sidecar.
+    :return: Dictionary of Game attribute: Series.
+    '''
+    if not cache or pyarrow is None:
+        return read_columns(pd.read_excel(path)[4:])
+
+    stat = os.stat(path)
+    meta_path = path + '.cache.json'
+    # Always derived from the workbook's path, never read from the metadata
+    data_path = path + '.cache.feather'
+    meta = None
+    if os.path.isfile(meta_path):
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+        except ValueError:
+            meta = None
+
+    if meta is not None and meta.get('version') == sheet_cache_version and os.path.isfile(data_path):
+        if meta['mtime'] == stat.st_mtime and meta['size'] == stat.st_size:
+            return load_sheet_cache(data_path)
+        # Synced or touched but not edited
+        if meta['size'] == stat.st_size and meta['hash'] == file_hash(path):
+            meta['mtime'] = stat.st_mtime
+            write_sheet_meta(meta_path, meta)
+            return load_sheet_cache(data_path)
+
+    columns = read_columns(pd.read_excel(path)[4:])
+
+    meta = {'version': sheet_cache_version, 'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': file_hash(path)}
+    try:
+        pd.DataFrame(columns).reset_index(drop=True).to_feather(data_path)
+        write_sheet_meta(meta_path, meta)
+    except OSError:
+        # The cache is only an optimisation, so a read-only folder is not an error
+        pass
+    return columns
+
+
+def load_sheet_cache(data_path):
+    frame = pd.read_feather(data_path)
+    return {field: frame[field] for field in game_fields}
+
+
+def write_sheet_meta(meta_path, meta):
+    # Written last and replaced in one step, so that a sidecar is never used with the wrong metadata
+    with open(meta_path + '.part', 'w') as file:
+        json.dump(meta, file)
+    os.replace(meta_path + '.part', meta_path)
+
+
+def build_games(columns):
+    '''
+    Builds the games in columns of the sheet, with their DLC and included games.
+    :param columns: Dictionary of Game attribute: Series, as from read_columns.
+    :return: Tuple of (list of games, list of DLC and list of included games from the rows above the first game, which
+    belong to a game before these columns, if any).
+    '''
+    titles = columns['title']
+    is_dlc = titles.str.contains(' + ', regex=False).to_numpy()
+    is_include = titles.str.contains(' ^ ', regex=False).to_numpy() & ~is_dlc
+    is_game = ~(is_dlc | is_include)
+    # Each row belongs to the last game row at or above it; rows above the first game belong to none
+    game_rows = is_game.nonzero()[0]
+    parents = is_game.cumsum() - 1
+
+    columns['title'] = titles.str.replace('   + ', '', regex=False).str.replace('   ^ ', '', regex=False)
+    games = make_games(columns)
+
+    # Children sorted by parent, DLC before includes, so that each game's DLC and includes are two ranges of one
+    # shared list
+    child_rows = ((~is_game) & (parents >= 0)).nonzero()[0]
+    keys = parents[child_rows] * 2 + is_include[child_rows]
+    order = np.argsort(keys, kind='stable')
+    child_rows = child_rows[order]
+    keys = keys[order]
+    children = [games[i] for i in child_rows]
+
+    numbers = np.arange(len(game_rows)) * 2
+    dlc_starts = np.searchsorted(keys, numbers).tolist()
+    include_starts = np.searchsorted(keys, numbers + 1).tolist()
+    include_stops = np.searchsorted(keys, numbers + 2).tolist()
+
+    orphans = (parents < 0).nonzero()[0]
+    dlc = [games[i] for i in orphans if is_dlc[i]]
+    includes = [games[i] for i in orphans if is_include[i]]
+
+    games = [games[i] for i in game_rows]
+    for game, dlc_start, include_start, include_stop in zip(games, dlc_starts, include_starts, include_stops):
+        game._children = children
+        game._dlc_start = dlc_start
+        game._dlc_stop = game._include_start = include_start
+        game._include_stop = include_stop
+
+    return games, dlc, includes
+
+
+def read_sheet_chunks(path, chunk_size=10000):
+    '''
+    Reads a Games Library workbook, or a csv export of it, a chunk of rows at a time, skipping the header and the four
+    rows below it as import_from_xl does.
+    :param path: Path to the .xlsx or .csv file.
+    :param chunk_size: Number of rows in each chunk.
+    :return: Generator of DataFrames with the columns of the sheet, in order.
+    '''
+    if path.lower().endswith('.csv'):
+        for chunk in pd.read_csv(path, chunksize=chunk_size, skiprows=range(1, 5)):
+            yield chunk
+        return
+
+    if openpyxl is None:
+        raise ImportError("openpyxl is required to stream rows from a workbook.")
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        next(rows, None)
+        for i in range(4):
+            next(rows, None)
+
+        width = len(game_fields)
+        chunk = list()
+        blank = 0
+        nan = float('nan')
+        for row in rows:
+            values = [nan if v is None else v for v in row[:width]]
+            values += [nan] * (width - len(values))
+            # Blank rows only count when something follows them, as with read_excel
+            if all(v is nan for v in values):
+                blank += 1
+                continue
+            for i in range(blank):
+                chunk.append([nan] * width)
+            blank = 0
+            chunk.append(values)
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk, columns=game_fields)
+                chunk = list()
+        if chunk:
+            yield pd.DataFrame(chunk, columns=game_fields)
+    finally:
+        workbook.close()
+
+
+def stream_games(path, chunk_size=10000, batches=False):
+    '''
+    Reads the games in a Games Library workbook or csv export a chunk at a time. The last game of each chunk is held
+    back until the next chunk, so that DLC and include rows carried over to it are still attached. Memory use depends
+    on chunk_size rather than on the size of the sheet, and the games can be counted as they come, eg with
+    LibraryStats(stream_games(path)).
+    :param path: Path to the .xlsx or .csv file.
+    :param chunk_size: Number of rows to read at a time.
+    :param batches: Yield a list of games for each chunk instead of one game at a time.
+    :return: Generator of games, or of lists of games.
+    '''
+    pending = None
+    for chunk in read_sheet_chunks(path, chunk_size):
+        games, dlc, includes = build_games(read_columns(chunk))
+
+        batch = list()
+        if pending is not None:
+            if dlc or includes:
+                pending.set_children(pending.dlc + tuple(dlc), pending.includes + tuple(includes))
+            if games:
+                batch.append(pending)
+                pending = None
+        if games:
+            batch.extend(games[:-1])
+            pending = games[-1]
+
+        if batches:
+            if batch:
+                yield batch
+        else:
+            yield from batch
 
-    def import_from_xl(self, path="C:\\Users\\Lachlan\\Google Drive\\Projects\\Python\\libraries\\Games Library.xlsx"):
-        lib = pd.read_excel(path)
-        lib = lib.as_matrix()
-        lib = lib[4:]
-
-        for i in range(len(lib)):
-
-            row = lib[i]
-
-            if ' + ' not in str(row[0]) and ' ^ ' not in str(row[0]):
-
-                game = Game()
-                game.title = str(row[0])
-                game.instance_of = str(row[1])
-                game.platform = str(row[2])
-                game.formats = str(row[3])
-                game.series = str(row[4])
-                game.series_num = str(row[5])
-                game.developer = str(row[6])
-                game.publisher = str(row[7])
-                game.local_players = str(row[8])
-                game.online_players = str(row[9])
-                game.release_date = str(row[10])
-                game.obtained = str(row[11])
-                game.completion = str(row[12])
-                game.metacritic = str(row[13])
-                if 'nan' in game.metacritic:
-                    game.metacritic = '0.0'
-                game.gamerankings = str(row[14])
-                game.my_rating = str(row[15])
-                game.condition = str(row[16])
-                if row[17] == 'nan' or row[17] == 'N':
-                    game.box = False
-                elif row[17] == 'Y':
-                    game.box = True
-                if row[18] == 'nan' or row[18] == 'N':
-                    game.manual = False
-                elif game.manual == 'Y':
-                    game.manual = True
-                game.other = str(row[19])
-                game.gb_notes = str(row[20])
-                game.key = str(row[21])
-                game.generation = float(row[22])
-
-                if i < len(lib) - 1:
-
-                    j = i + 1
-
-                    while ' + ' in str(lib[j][0]) or ' ^ ' in str(lib[j][0]):
-
-                        row_n = lib[j]
-
-                        if ' + ' in row_n[0]:
-
-                            dlc = Game()
-
-                            dlc = Game()
-                            dlc.title = row_n[0].replace('   + ', '')
-                            dlc.instance_of = row_n[1]
-                            dlc.platform = row_n[2]
-                            dlc.formats = row_n[3]
-                            dlc.series = row_n[4]
-                            dlc.series_num = row_n[5]
-                            dlc.developer = row_n[6]
-                            dlc.publisher = row_n[7]
-                            dlc.local_players = row_n[8]
-                            dlc.online_players = row_n[9]
-                            dlc.release_date = row_n[10]
-                            dlc.obtained = row_n[11]
-                            dlc.completion = row_n[12]
-                            dlc.metacritic = str(row_n[13])
-                            dlc.gamerankings = str(row_n[14])
-                            dlc.my_rating = str(row_n[15])
-                            dlc.condition = row_n[16]
-                            if row_n[17] == 'nan' or row_n[17] == 'N':
-                                dlc.box = False
-                            elif row_n[17] == 'Y':
-                                dlc.box = True
-                            if row_n[18] == 'nan' or row_n[18] == 'N':
-                                dlc.manual = False
-                            elif dlc.manual == 'Y':
-                                dlc.manual = True
-                            dlc.other = row_n[19]
-                            dlc.gb_notes = row_n[20]
-                            dlc.key = row_n[21]
-                            dlc.generation = float(row_n[22])
-
-                            game.dlc.append(dlc)
-
-
-                        else:
-
-                            include = Game()
-
-                            include = Game()
-                            include.title = row_n[0].replace('   ^ ', '')
-                            include.instance_of = row_n[1]
-                            include.platform = row_n[2]
-                            include.formats = row_n[3]
-                            include.series = row_n[4]
-                            include.series_num = row_n[5]
-                            include.developer = row_n[6]
-                            include.publisher = row_n[7]
-                            include.local_players = row_n[8]
-                            include.online_players = row_n[9]
-                            include.release_date = row_n[10]
-                            include.obtained = row_n[11]
-                            include.completion = row_n[12]
-                            include.metacritic = float(row_n[13])
-                            include.gamerankings = float(row_n[14])
-                            include.my_rating = float(row_n[15])
-                            include.condition = row_n[16]
-                            if row_n[17] == 'nan' or row_n[17] == 'N':
-                                include.box = False
-                            elif row_n[17] == 'Y':
-                                include.box = True
-                            if row_n[18] == 'nan' or row_n[18] == 'N':
-                                include.manual = False
-                            elif include.manual == 'Y':
-                                include.manual = True
-                            include.other = row_n[19]
-                            include.gb_notes = row_n[20]
-                            include.key = row_n[21]
-                            include.generation = float(row_n[22])
-
-                            game.includes.append(include)
-
-                        j += 1
-
-                self.games.append(game)
+    if pending is not None:
+        if batches:
+            yield [pending]
+        else:
+            yield pending
 
 
-class Game:
-    def __init__(self):
-        self.title = str()
-        self.instance_of = str()
-        self.platform = str()
-        self.formats = str()
-        self.series = str()
-        self.series_num = str()
-        self.developer = str()
-        self.publisher = str()
-        self.local_players = str()
-        self.online_players = str()
-        self.release_date = str()
-        self.obtained = str()
-        self.completion = str()
-        self.metacritic = float()
-        self.gamerankings = float()
-        self.my_rating = float()
-        self.condition = str()
-        self.box = False
-        self.manual = False
-        self.other = str()
-        self.gb_notes = str()
-        self.key = str()
-        self.generation = float()
-        self.includes = list()
-        self.dlc = list()
+def make_games(columns):
+    '''
+    :param columns: Dictionary of Game attribute: Series, as from read_columns.
+    :return: List of a Game for each row.
+    '''
+    # The collector would otherwise run many times over the new games, which cannot form cycles yet
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        games = [Game(*values) for values in zip(*(columns[field].tolist() for field in game_fields))]
+    finally:
+        if enabled:
+            gc.enable()
+    return games
 
 
 class Completion:
@@ -441,5 +681,402 @@ class TitleNum:
         else:
             return False
 
+    def __hash__(self):
+        return hash(self.title)
+
     def increment(self):
         self.num += 1
+
+
+class GameList(list):
+    '''
+    A list of games that counts the changes made to it other than adding games at the end, so that anything computed
+    from it can tell whether it only needs to take in the new games or is out of date.
+    '''
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.layout = 0
+
+    def _changed(self):
+        self.layout += 1
+
+    def insert(self, index, game):
+        super().insert(index, game)
+        self._changed()
+
+    def remove(self, game):
+        super().remove(game)
+        self._changed()
+
+    def pop(self, index=-1):
+        game = super().pop(index)
+        self._changed()
+        return game
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        # Order matters too: equal counts are reported in the order the games were first seen
+        super().sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        super().reverse()
+        self._changed()
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._changed()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._changed()
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self._changed()
+        return self
+
+
+class LibraryStats:
+    '''
+    Every count the GameLibrary reports on, gathered in a single pass over the games. Stats for several libraries can
+    be combined with update.
+    '''
+    def __init__(self, games=()):
+        self.games = set()
+        self.dlcs = dict()
+        self.owned = Counter()
+        # (instance of, platform): copies, for telling which libraries own the same game
+        self.copies = Counter()
+        self.series = Counter()
+        self.platforms = Counter()
+        self.formats = Counter()
+        self.completion = Counter()
+        # series: [total rating, number of rated games]
+        self.series_ratings = dict()
+
+        for game in games:
+            self.add(game)
+
+    def add(self, game):
+        series = str(game.series)
+        self.series[series] += 1
+        self.platforms[str(game.platform)] += 1
+        self.formats[str(game.formats)] += 1
+        self.completion[str(game.completion)] += 1
+
+        rating = to_float(game.my_rating)
+        if series != 'nan' and rating is not None:
+            total = self.series_ratings.setdefault(series, [0.0, 0])
+            total[0] += rating
+            total[1] += 1
+
+        instance_of = str(game.instance_of)
+        if instance_of != 'nan':
+            self.games.add(instance_of)
+            self.owned[instance_of] += 1
+            self.copies[(instance_of, str(game.platform))] += 1
+
+            for dlc in game.dlc:
+                title = str(dlc.title)
+                if title != 'nan' and title not in self.dlcs:
+                    self.dlcs[title] = TitleNum(title, 1)
+                self.add_copy(dlc)
+
+            for include in game.includes:
+                self.games.add(str(include.instance_of))
+                self.add_copy(include)
+
+    def add_copy(self, game):
+        instance_of = str(game.instance_of)
+        self.owned[instance_of] += 1
+        if instance_of != 'nan':
+            self.copies[(instance_of, str(game.platform))] += 1
+
+    def update(self, other):
+        '''
+        Adds the counts of another LibraryStats to these, as if its games had been added after these ones.
+        '''
+        self.games |= other.games
+        for title in other.dlcs:
+            if title not in self.dlcs:
+                self.dlcs[title] = TitleNum(title, 1)
+        for counts, other_counts in ((self.owned, other.owned), (self.copies, other.copies),
+                                     (self.series, other.series), (self.platforms, other.platforms),
+                                     (self.formats, other.formats), (self.completion, other.completion)):
+            counts.update(other_counts)
+        for series, (total, count) in other.series_ratings.items():
+            ratings = self.series_ratings.setdefault(series, [0.0, 0])
+            ratings[0] += total
+            ratings[1] += count
+
+    def average_ratings(self):
+        '''
+        :return: List of (series, average rating, number of rated games), highest average first.
+        '''
+        averages = [(series, total / count, count) for series, (total, count) in self.series_ratings.items()]
+        averages.sort(key=lambda a: a[1], reverse=True)
+        return averages
+
+
+class GameQuery:
+    '''
+    A query over the games of a GameLibrary, built up by chaining where, range, filter, sort and limit, and run by
+    games, count or iterating over it. where and range on the indexed and sorted fields use the library's indexes.
+    '''
+    def __init__(self, library):
+        self.library = library
+        self.conditions = list()
+        self.predicates = list()
+        self.sort_key = None
+        self.sort_reverse = False
+        self.max_results = None
+
+    def where(self, **values):
+        '''
+        Keeps the games whose fields have the given values; a list, tuple or set of values matches any of them.
+        '''
+        for field, value in values.items():
+            if not isinstance(value, (list, tuple, set, frozenset)):
+                value = (value,)
+            self.conditions.append(('where', field, value))
+        return self
+
+    def range(self, field, low=None, high=None):
+        '''
+        Keeps the games with low <= field <= high; either end may be None. Games without a value (nan) never match.
+        '''
+        self.conditions.append(('range', field, (low, high)))
+        return self
+
+    def filter(self, predicate):
+        '''
+        Keeps the games for which predicate(game) is true.
+        '''
+        self.predicates.append(predicate)
+        return self
+
+    def sort(self, key, reverse=False):
+        '''
+        :param key: Game attribute name or function of a game. Games without a numeric value (nan) sort first.
+        '''
+        self.sort_key = key
+        self.sort_reverse = reverse
+        return self
+
+    def limit(self, num):
+        self.max_results = num
+        return self
+
+    def _positions(self, condition):
+        kind, field, value = condition
+        if kind == 'where':
+            if field in indexed_fields:
+                index = self.library.index(field)
+                return set(p for v in value for p in index.get(v, ()))
+            return set(p for p, game in enumerate(self.library.games) if getattr(game, field) in value)
+
+        low, high = value
+        if field in sorted_fields:
+            values, positions = self.library.sorted_index(field)
+            start = 0 if low is None else bisect_left(values, low)
+            stop = len(values) if high is None else bisect_right(values, high)
+            return set(positions[start:stop])
+        return set(p for p, game in enumerate(self.library.games)
+                   if (low is None or getattr(game, field) >= low) and (high is None or getattr(game, field) <= high))
+
+    def games(self):
+        '''
+        :return: List of the matching games, in library order unless sorted.
+        '''
+        library_games = self.library.games
+        if self.conditions:
+            matches = None
+            for condition in self.conditions:
+                positions = self._positions(condition)
+                matches = positions if matches is None else matches & positions
+                if not matches:
+                    break
+            games = [library_games[p] for p in sorted(matches)]
+        else:
+            games = list(library_games)
+
+        for predicate in self.predicates:
+            games = [game for game in games if predicate(game)]
+
+        if self.sort_key is not None:
+            key = self.sort_key
+            if isinstance(key, str):
+                get = attrgetter(key)
+                if key in sorted_fields:
+                    # nans do not compare, so they are put ahead of every number
+                    key = lambda g: (get(g) == get(g), get(g))
+                else:
+                    key = get
+            games.sort(key=key, reverse=self.sort_reverse)
+
+        if self.max_results is not None:
+            games = games[:self.max_results]
+        return games
+
+    def count(self):
+        return len(self.games())
+
+    def __iter__(self):
+        return iter(self.games())
+
+
+class LibraryMerge(LibraryReports):
+    '''
+    Several game libraries analysed together, eg one per person or per shelf. A game is identified across libraries by
+    its instance of and platform. The LibraryReports methods report on all of the libraries combined.
+    '''
+    def __init__(self, names, stats):
+        '''
+        :param names: Name of each library; the names must be unique.
+        :param stats: LibraryStats of each library, in the same order.
+        '''
+        repeated = [name for name, count in Counter(names).items() if count > 1]
+        if repeated:
+            raise ValueError("Library names must be unique; repeated: " + ', '.join(map(str, repeated)))
+        self.names = list(names)
+        self.library_stats = list(stats)
+        self.stats = LibraryStats()
+        for stats in self.library_stats:
+            self.stats.update(stats)
+
+    def owners(self):
+        '''
+        :return: Dictionary of (instance of, platform): list of the names of the libraries that own it.
+        '''
+        owners = dict()
+        for name, stats in zip(self.names, self.library_stats):
+            for key in stats.copies:
+                owners.setdefault(key, []).append(name)
+        return owners
+
+    def overlap(self):
+        '''
+        :return: Dictionary of (instance of, platform): list of owner names, for the games owned by more than one
+        library, most owners first.
+        '''
+        shared = [(key, names) for key, names in self.owners().items() if len(names) > 1]
+        shared.sort(key=lambda s: len(s[1]), reverse=True)
+        return dict(shared)
+
+    def shared_counts(self):
+        '''
+        :return: Dictionary of (name, name): number of games both libraries own, for every pair of libraries.
+        '''
+        keys = [set(stats.copies) for stats in self.library_stats]
+        counts = dict()
+        for i in range(len(self.names)):
+            for j in range(i + 1, len(self.names)):
+                counts[(self.names[i], self.names[j])] = len(keys[i] & keys[j])
+        return counts
+
+    def show_overlap(self, num=10):
+        '''
+        Prints how many games each pair of libraries shares, then the games owned by the most libraries.
+        :param num: Number of shared games to show, or None for all of them.
+        '''
+        for (a, b), count in self.shared_counts().items():
+            print(a + " & " + b + ": " + str(count))
+        print()
+
+        for i, ((instance_of, platform), names) in enumerate(list(self.overlap().items())[:num]):
+            print(str(i) + ". " + instance_of + " (" + platform + "): " + ", ".join(names))
+        print()
+
+
+def read_library_stats(path, chunk_size=10000, cache=False):
+    '''
+    The LibraryStats of a Games Library workbook, through its sidecar cache if cache is True, or of a csv export,
+    streamed.
+    '''
+    if path.lower().endswith('.csv'):
+        return LibraryStats(stream_games(path, chunk_size=chunk_size))
+    return GameLibrary(path, cache=cache).stats
+
+
+def merge_libraries(libraries, names=None, workers=None, cache=False):
+    '''
+    Combines several game libraries for reporting on together. Libraries given as paths are read concurrently in a
+    process pool.
+    :param libraries: GameLibrary objects and/or paths to workbooks or csv exports.
+    :param names: Name of each library, which must be unique; defaults to the file name of a path without its
+    extension (with it, where two would otherwise be the same), or 'Library n'.
+    :param workers: Maximum number of processes, or None for one per CPU.
+    :param cache: Whether workbooks are read through their sidecar caches; see read_sheet.
+    :return: A LibraryMerge.
+    '''
+    libraries = list(libraries)
+    if names is None:
+        names = default_library_names(libraries)
+
+    stats = [None if isinstance(l, str) else l.stats for l in libraries]
+    paths = [l for l in libraries if isinstance(l, str)]
+    if paths:
+        read = partial(read_library_stats, cache=cache)
+        if len(paths) == 1 or workers == 1:
+            results = [read(p) for p in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(read, paths))
+        results = iter(results)
+        stats = [next(results) if s is None else s for s in stats]
+
+    return LibraryMerge(names, stats)
+
+
+def default_library_names(libraries):
+    '''
+    Names libraries by file name, adding the extension and then a number to names that would otherwise be repeated.
+    '''
+    names = [os.path.splitext(os.path.basename(l))[0] if isinstance(l, str) else 'Library ' + str(i)
+             for i, l in enumerate(libraries)]
+    counts = Counter(names)
+    names = [os.path.basename(l) if isinstance(l, str) and counts[name] > 1 else name
+             for name, l in zip(names, libraries)]
+    counts = Counter(names)
+    numbers = Counter()
+    for i, name in enumerate(names):
+        if counts[name] > 1:
+            numbers[name] += 1
+            names[i] = f"{name} ({numbers[name]})"
+    return names
+
+
+def to_text(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def to_float(value):
+    '''
+    :return: value as a float, or None if it is empty or not a number.
+    '''
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if value != value else value
+
+
+def rank_counts(counts):
+    '''
+    :param counts: Counter of titles, in the order they were first seen.
+    :return: List of TitleNum without nans, most common first and ties in order of first appearance.
+    '''
+    # sorted is stable, so equal counts keep the order in which they were first seen
+    return sorted((TitleNum(t, n) for t, n in counts.items() if t != 'nan'), key=lambda t: t.num, reverse=True)
+
+
+def show_counts(counts):
+    for i, c in enumerate(counts):
+        print(str(i) + ". " + str(c.title) + " (" + str(c.num) + ")")
+    print()
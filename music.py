@@ -1,59 +1,516 @@
 import os
-import taglib as tl
+import sys
+import numpy as np
 import csv
+import io
 import shutil
+import json
+import struct
+import sqlite3
+import errno
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from copy import copy as shallow_copy
+from collections import Counter
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from utils import *
+from utils import _logger as utils_logger
+
+try:
+    import taglib as tl
+except ImportError:
+    tl = None
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
 
 song_filetypes = ['mp3', 'm4a', 'm4p', 'MP3', 'aif', 'm4v', 'Mp3', 'wav', 'mpg']
 library_types = ['itunes', 'google play music', 'takeout', 'comparison', 'takeout csv']
-empty_lists = [None, [], [""]]
+match_modes = ['exact', 'normalised', 'fuzzy']
+snapshot_magic = b'SDTSNAP\x00'
+snapshot_version = 1
+verbosity_levels = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG}
+
+
+def set_verbosity(verbosity: int = 1):
+    """
+    Prints the messages of the music functions, and of the utils functions they use, to the console: 0 for warnings
+    only, 1 for a summary of each step, 2 for a line for every file and directory handled. Until this is called,
+    messages only go wherever the application's own logging configuration sends them; once it is, they are no longer
+    passed on to it as well.
+    """
+    if verbosity not in verbosity_levels:
+        raise ValueError("Only verbosity levels ", list(verbosity_levels), "accepted.")
+    for log in (logger, utils_logger):
+        if not any(type(h) is logging.StreamHandler for h in log.handlers):
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            log.addHandler(handler)
+        log.propagate = False
+        log.setLevel(verbosity_levels[verbosity])
 
 
-def all_playlists_takeout_to_itunes(path, output):
+empty_lists = [None, [], [""]]
+# The only tags the tree is built from; the rest are loaded on demand through Song.tags.
+core_tags = ('ARTIST', 'ALBUMARTIST', 'ALBUM', 'TITLE')
+takeout_fields = ('Title', 'Album', 'Artist')
+
+
+def all_playlists_takeout_to_itunes(path, output, workers: int = 4, track_workers: int = 4):
+    """
+    Converts every playlist in a Takeout export to an iTunes playlist text file, several playlists at a time.
+    :param workers: Number of playlists converted at once.
+    :param track_workers: Number of threads reading the track csvs of each large playlist; see
+        playlist_takeout_to_itunes.
+    """
     path = check_trailing_slash(path)
     output = check_trailing_slash(output)
-    print("Looking for playlists at", path)
-    for title in filter(lambda d: os.path.isdir(path + d), os.listdir(path)):
-        dir = path + title + "\\Tracks\\"
+    logger.info(f"Looking for playlists at {path}")
+    with os.scandir(path) as entries:
+        playlists = [entry for entry in entries if entry.is_dir()]
+    jobs = []
+    for entry in playlists:
+        title = entry.name
+        dir = os.path.join(entry.path, "Tracks")
         if os.path.isdir(dir):
-            print("Reading playlist", title, "from", dir)
-            playlist_takeout_to_itunes(path=dir, output=output + title + ".txt")
-
-
-def playlist_takeout_to_itunes(path, output):
+            logger.info(f"Reading playlist {title} from {dir}")
+            jobs.append((dir, output + title + ".txt"))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() so that any exception raised in a worker is raised here.
+        list(executor.map(lambda job: playlist_takeout_to_itunes(path=job[0], output=job[1],
+                                                                 workers=track_workers), jobs))
+
+
+def playlist_takeout_to_itunes(path, output, workers: int = None, parallel_threshold: int = 256):
+    """
+    :param workers: Number of threads reading the track csvs, for playlists with more than parallel_threshold tracks.
+    """
     path = check_trailing_slash(path)
-    playlist = []
-    for file in os.listdir(path):
-        print("Getting file", file)
-        file = path + file
-        with open(file, newline='', encoding="utf8") as csvfile:
-            reader = csv.DictReader(csvfile)
-
-            csv_row = reader.__next__()
-        song = {'Title': sanitise_html_encoding(csv_row['Title']),
-                'Album': sanitise_html_encoding(csv_row['Album']),
-                'Artist': sanitise_html_encoding(csv_row['Artist']),
-                'Index': sanitise_html_encoding(csv_row['Playlist Index'])}
-        playlist.append(song)
-    playlist.sort(key=lambda s: int(s['Index']))
-
-    print("Writing playlist to", output)
+    files = [file.path for file in walk_files(path, recurse=False)]
+    fields = takeout_fields + ('Playlist Index',)
+    if workers is not None and len(files) > parallel_threshold:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(read_takeout_row, files, [fields] * len(files), chunksize=32))
+    else:
+        rows = [read_takeout_row(file, fields) for file in files]
+    indices = [int(row[3]) for row in rows]
+
+    # Playlist indices are normally a permutation of a contiguous range, so each track can be put straight into its
+    # slot; otherwise (gaps or repeats) fall back to a stable sort, as before.
+    first = min(indices, default=0)
+    playlist = [None] * len(rows)
+    for index, row in zip(indices, rows):
+        slot = index - first
+        if slot >= len(playlist) or playlist[slot] is not None:
+            playlist = [row for index, row in sorted(zip(indices, rows), key=lambda r: r[0])]
+            break
+        playlist[slot] = row
+
+    logger.info(f"Writing playlist to {output}")
     with open(output, mode='w', encoding='utf8') as textfile:
         textfile.write('Name\tArtist\tAlbum\n')
-        for song in playlist:
-            textfile.write(f"{song['Title']}\t{song['Artist']}\t{song['Album']}\n")
-    textfile.close()
+        textfile.writelines(f"{title}\t{artist}\t{album}\n" for title, album, artist, index in playlist)
+
+
+def read_takeout_row(path: str, fields: tuple = takeout_fields):
+    """
+    Reads the single data row of a Google Takeout per-track csv. Rows without quotes are split directly; only those
+    with quoted fields go through the csv module.
+    :param fields: Columns to return.
+    :return: List of the values of fields, with HTML entities decoded.
+    """
+    with open(path, newline='', encoding="utf8") as csvfile:
+        header = csvfile.readline()
+        row = csvfile.read()
+    if '"' in header:
+        header = next(csv.reader([header]))
+    else:
+        header = header.rstrip('\r\n').split(',')
+    if '"' in row:
+        row = next(csv.reader(io.StringIO(row)))
+    else:
+        row = row.split('\n', 1)[0].rstrip('\r').split(',')
+    values = []
+    for field in fields:
+        i = header.index(field)
+        values.append(sanitise_html_encoding(row[i]) if i < len(row) else '')
+    return values
+
+
+def read_tags(path: str, is_csv: bool = False, full: bool = False):
+    """
+    Reads the tags of a single file; kept at module level so that it can be handed to a process pool.
+    :param path: Path to the audio file, or to the per-track csv for Takeout libraries.
+    :param is_csv: Whether the file is a Takeout csv rather than an audio file.
+    :param full: Return every tag, rather than only the core_tags the tree needs.
+    :return: dict of tag lists, as returned by taglib.
+    """
+    if is_csv:
+        # try:
+        title, album, artist = read_takeout_row(path)
+        tags = {'TITLE': [title],
+                'ALBUM': [album],
+                'ARTIST': [artist],
+                'ALBUMARTIST': [artist]}
+        # except UnicodeDecodeError:
+        #     tags = {'TITLE': 'ERROR',
+        #             'ALBUM': 'ERROR',
+        #             'ARTIST': 'ERROR',
+        #             'ALBUMARTIST': 'ERROR'}
+        return tags
+    else:
+        if tl is None:
+            raise ImportError("pytaglib is required to read tags from audio files.")
+        file = tl.File(path)
+        tags = file.tags
+        file.close()
+        if not full:
+            tags = {tag: tags[tag] for tag in core_tags if tag in tags}
+        return tags
+
+
+def audio_range(path: str):
+    """
+    Finds the part of a file holding the audio stream, so that files which differ only in their tags can be matched.
+    Only ID3 tags (MP3) are skipped; for other formats the whole file is used.
+    :return: (start, stop) byte offsets.
+    """
+    size = os.path.getsize(path)
+    start = 0
+    stop = size
+    if get_filetype(path).lower() == 'mp3':
+        with open(path, 'rb') as file:
+            header = file.read(10)
+            if len(header) == 10 and header[:3] == b'ID3':
+                # The ID3v2 size is stored as a 28-bit 'syncsafe' integer, excluding the header (and footer, if any).
+                start = 10 + ((header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9])
+                if header[5] & 0x10:
+                    start += 10
+            if size >= 128:
+                file.seek(size - 128)
+                if file.read(3) == b'TAG':
+                    stop = size - 128
+    return min(start, stop), stop
+
+
+def _compared_range(path: str, audio: bool):
+    return audio_range(path) if audio else (0, os.path.getsize(path))
+
+
+def _hash_range(path: str, byte_range: tuple, partial: int):
+    start, stop = byte_range
+    if partial is not None:
+        stop = min(stop, start + partial)
+    return file_hash(path, start=start, stop=stop)
+
+
+def find_duplicate_files(paths: list, workers: int = 4, audio: bool = False, partial: int = 1 << 16):
+    """
+    Finds files with identical contents. Files are first grouped by size, then candidates are compared on a hash of
+    their first bytes, and only files that still collide are hashed in full. Sizing (which reads the tags when audio is
+    set) and hashing are done on a thread pool.
+    :param paths: Files to check.
+    :param workers: Number of threads to hash with.
+    :param audio: Compare only the audio stream (see audio_range), so that files with different tags can still match.
+    :param partial: Number of bytes hashed in the first pass.
+    :return: List of clusters, each a list of paths of identical files, in the order they appear in paths.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        ranges = dict(zip(paths, executor.map(_compared_range, paths, [audio] * len(paths))))
+        by_size = {}
+        for path in paths:
+            start, stop = ranges[path]
+            by_size.setdefault(stop - start, []).append(path)
+        candidates = [group for group in by_size.values() if len(group) > 1]
+
+        for partial_size in (partial, None):
+            files = [path for group in candidates for path in group]
+            hashes = dict(zip(files, executor.map(_hash_range, files, [ranges[path] for path in files],
+                                                  [partial_size] * len(files))))
+            regrouped = []
+            for group in candidates:
+                by_hash = {}
+                for path in group:
+                    by_hash.setdefault(hashes[path], []).append(path)
+                regrouped.extend(g for g in by_hash.values() if len(g) > 1)
+            candidates = regrouped
+
+    order = {path: i for i, path in enumerate(paths)}
+    for group in candidates:
+        group.sort(key=order.get)
+    candidates.sort(key=lambda g: order[g[0]])
+    return candidates
+
+
+def transfer_file(src: str, dst: str, move: bool = True):
+    """
+    Moves or copies a single file, in a way that is safe to repeat after an interruption: a transfer whose result is
+    already in place is skipped, and copies are written to a temporary file that is only renamed into place once
+    complete. Copies keep the source's modification time, and an existing destination only counts as already copied
+    if its size and modification time both match. Moves are renames where the source and destination share a
+    filesystem.
+    :return: True if the file was transferred, False if it was skipped.
+    """
+    if move:
+        if not os.path.exists(src) and os.path.exists(dst):
+            return False
+        try:
+            os.replace(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(src=src, dst=dst)
+    else:
+        if os.path.exists(dst):
+            src_stat = os.stat(src)
+            dst_stat = os.stat(dst)
+            # FAT filesystems only store modification times to the nearest 2 seconds
+            if dst_stat.st_size == src_stat.st_size and abs(dst_stat.st_mtime - src_stat.st_mtime) < 2:
+                return False
+        partial = dst + '.part'
+        shutil.copy2(src=src, dst=partial)
+        os.replace(partial, dst)
+    return True
+
+
+class ScanProgress:
+    def __init__(self, callback=None, interval: int = 1000):
+        """
+        Counters and per-phase timings for a scan or transfer: files handled, bytes read, and the time spent walking
+        directories, reading tags, inserting into the tree and transferring files.
+        :param callback: Called as callback(event, stats), where stats is the dict returned by stats(), every interval
+            files and at the end of each scan ('populate') or transfer ('transfer').
+        :param interval: Number of files between 'progress' callbacks.
+        """
+        self.callback = callback
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.cached = 0
+        self.transferred = 0
+        self.timings = {}
+        self.start = time.perf_counter()
+
+    def __str__(self):
+        stats = self.stats()
+        timings = ', '.join(f"{phase} {seconds:.2f} s" for phase, seconds in stats['timings'].items())
+        return (f"{stats['files']} files ({stats['bytes'] / 1e6:.1f} MB read) in {stats['elapsed']:.2f} s: "
+                f"{stats['files_per_second']:.1f} files/s, {stats['bytes_per_second'] / 1e6:.2f} MB/s [{timings}]")
+
+    @contextmanager
+    def timer(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.) + time.perf_counter() - start
+
+    def timed(self, phase: str, iterable):
+        """
+        Yields from iterable, counting the time spent getting each item against phase.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def update(self, files: int = 1, bytes_read: int = 0):
+        self.files += files
+        self.bytes += bytes_read
+        if self.callback is not None and self.files % self.interval < files:
+            self.callback('progress', self.stats())
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start
+        return {'files': self.files,
+                'bytes': self.bytes,
+                'cached': self.cached,
+                'transferred': self.transferred,
+                'elapsed': elapsed,
+                'files_per_second': self.files / elapsed if elapsed > 0 else 0.,
+                'bytes_per_second': self.bytes / elapsed if elapsed > 0 else 0.,
+                'timings': dict(self.timings)}
+
+    def finish(self, event: str):
+        logger.info(f"Finished {event}: {self}")
+        if self.callback is not None:
+            self.callback(event, self.stats())
+
+
+class TransferPlan:
+    def __init__(self):
+        """
+        The directories to create and files to move or copy that result from building a tree with sort_files, or from
+        a comparison with copy; nothing is touched on disk until execute is called.
+        """
+        self.directories = {}
+        self.transfers = []
+        self.destinations = set()
+
+    def __len__(self):
+        return len(self.transfers)
+
+    def add_directory(self, path: str):
+        self.directories[path] = None
+
+    def add(self, src: str, dst: str, move: bool = True):
+        """
+        Plans a transfer, unless another is already planned to the same destination or a file is already there, so that
+        no transfer can overwrite a file that another song stays in or is moved to.
+        :return: True if the transfer was planned, False if it was refused.
+        """
+        if dst in self.destinations or os.path.exists(dst):
+            logger.warning(f"Not transferring {src}: {dst} is already taken by another file.")
+            return False
+        self.destinations.add(dst)
+        self.transfers.append((src, dst, move))
+        return True
+
+    def execute(self, workers: int = 4, dry_run: bool = False, progress: ScanProgress = None):
+        """
+        Creates the planned directories, then carries out the transfers on a pool of threads. Transfers already
+        completed (eg before an interruption) are skipped, so a plan can be executed again to resume it.
+        :param workers: Number of transfers to run at once.
+        :param dry_run: Only print what would be done.
+        :param progress: Records the time taken and the number of files transferred.
+        :return: The number of files transferred.
+        """
+        if dry_run:
+            for directory in self.directories:
+                if not os.path.isdir(directory):
+                    print("Would create", directory)
+            for src, dst, move in self.transfers:
+                print("Would move" if move else "Would copy", src, "to", dst)
+            return 0
+        if progress is None:
+            progress = ScanProgress()
+        logger.info(f"Transferring {len(self.transfers)} files with {workers} workers...")
+        with progress.timer('transfer'):
+            for directory in self.directories:
+                os.makedirs(directory, exist_ok=True)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                done = 0
+                for (src, dst, move), transferred in zip(self.transfers,
+                                                         executor.map(lambda t: transfer_file(*t), self.transfers)):
+                    logger.debug(f"{'Moved' if move else 'Copied'} {src} to {dst}")
+                    done += transferred
+        progress.transferred += done
+        logger.info(f"Transferred {done} files; {len(self.transfers) - done} were already in place.")
+        progress.finish('transfer')
+        self.directories = {}
+        self.transfers = []
+        self.destinations = set()
+        return done
+
+    def save(self, path: str):
+        """
+        Writes the plan to a JSON file, so that it can be loaded and executed again if it is interrupted.
+        """
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'directories': list(self.directories), 'transfers': self.transfers}, file)
+
+    @classmethod
+    def load(cls, path: str):
+        plan = cls()
+        with open(path, encoding='utf-8') as file:
+            contents = json.load(file)
+        for directory in contents['directories']:
+            plan.add_directory(directory)
+        # Not checked again with add: destinations already written before an interruption are skipped by execute
+        for src, dst, move in contents['transfers']:
+            plan.destinations.add(dst)
+            plan.transfers.append((src, dst, move))
+        return plan
+
+
+class TagCache:
+    def __init__(self, path: str):
+        """
+        A persistent record of the tags read from each file, keyed on the file's path, modification time and size, so
+        that a rescan only has to open files that were added or changed since the last one.
+        :param path: Path to the SQLite database holding the cache; created if it does not exist.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tags '
+                                '(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, tags TEXT)')
+        self.entries = {}
+        for path, mtime, size, tags in self.connection.execute('SELECT path, mtime, size, tags FROM tags'):
+            self.entries[path] = (mtime, size, tags)
+        self.seen = set()
+        self.changed = {}
+
+    def get(self, path: str, mtime: float, size: int):
+        """
+        Returns the cached tags for path, or None if the file is not cached or has changed since it was.
+        """
+        self.seen.add(path)
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != mtime or entry[1] != size:
+            return None
+        return json.loads(entry[2])
+
+    def put(self, path: str, mtime: float, size: int, tags: dict):
+        self.seen.add(path)
+        entry = (mtime, size, json.dumps(tags))
+        self.entries[path] = entry
+        self.changed[path] = entry
+
+    def prune(self, root: str):
+        """
+        Drops the entries under root that were not seen since the cache was opened, ie files that have been deleted.
+        :return: The number of entries dropped.
+        """
+        removed = [p for p in self.entries if p.startswith(root) and p not in self.seen]
+        for path in removed:
+            del self.entries[path]
+            self.changed.pop(path, None)
+        self.connection.executemany('DELETE FROM tags WHERE path = ?', [(p,) for p in removed])
+        return len(removed)
+
+    def save(self):
+        self.connection.executemany('INSERT OR REPLACE INTO tags (path, mtime, size, tags) VALUES (?, ?, ?, ?)',
+                                    [(p,) + e for p, e in self.changed.items()])
+        self.connection.commit()
+        self.changed = {}
+
+    def close(self):
+        self.save()
+        self.connection.close()
 
 
 class SongDictTree:
     def __init__(self, path: str = None, library_type: str = 'Google Play Music', delete_duplicate: bool = False,
-                 sort_files: bool = False, recurse: bool = True, populate: bool = True):
+                 sort_files: bool = False, recurse: bool = True, populate: bool = True, workers: int = None,
+                 use_processes: bool = False, cache=None, transfer_workers: int = 4, dry_run: bool = False,
+                 progress_callback=None):
         """
 
         :param path: This should be the high-level directory in which the folders named after artists are contained.
+        :param workers: If given, tags are read on a pool of this many workers before the tree is built; otherwise the
+            library is scanned serially.
+        :param use_processes: Use a process pool instead of a thread pool for reading tags.
+        :param cache: Path to a TagCache database, or True to keep one in the library root; if given, only files that
+            were added or modified since the last scan have their tags read.
+        :param transfer_workers: Number of files moved at once when sort_files is set.
+        :param dry_run: With sort_files, only print the moves that would be made.
+        :param progress_callback: Called with the scan's counters and timings as it progresses; see ScanProgress.
         """
         self.num_tracks = 0
         self.artists = {}
+        self.transfers = TransferPlan()
+        self.progress = ScanProgress(callback=progress_callback)
         if library_type.lower() in library_types:
             self.type = library_type.lower()
         else:
@@ -61,12 +518,22 @@ class SongDictTree:
 
         if path is not None:
             self.path = check_trailing_slash(path)
+            if cache is True:
+                cache = self.path + '.tag_cache.sqlite'
+            if cache is None:
+                self.cache = None
+            else:
+                self.cache = TagCache(cache)
             if populate:
-                self.populate(delete_duplicate=delete_duplicate, sort_files=sort_files, recurse=recurse)
+                self.populate(delete_duplicate=delete_duplicate, sort_files=sort_files, recurse=recurse,
+                              workers=workers, use_processes=use_processes)
                 if sort_files:
-                    clear_empty_paths(path=path)
+                    self.transfers.execute(workers=transfer_workers, dry_run=dry_run, progress=self.progress)
+                    if not dry_run:
+                        clear_empty_paths(path=path)
         else:
             self.path = None
+            self.cache = None
 
         self.count_songs()
 
@@ -79,53 +546,252 @@ class SongDictTree:
     def get(self, item):
         return self.artists.get(item)
 
-    def populate(self, delete_duplicate: bool = False, sort_files: bool = False, recurse: bool = True):
+    def populate(self, delete_duplicate: bool = False, sort_files: bool = False, recurse: bool = True,
+                 workers: int = None, use_processes: bool = False):
         if self.type == 'takeout csv':
             is_csv = True
         else:
             is_csv = False
-        print('Building tree...')
-        self.add_directory(path=self.path, recurse=recurse, delete_duplicate=delete_duplicate, sort_files=sort_files,
-                           is_csv=is_csv)
-        print('Done.')
-
-    def add_directory(self, path, recurse: bool = False, delete_duplicate: bool = False, sort_files: bool = False,
-                      is_csv: bool = False):
-        path = check_trailing_slash(path)
-        print('Adding directory:', path)
-        if recurse:
-            for directory in filter(lambda n: os.path.isdir(path + n), os.listdir(path)):
-                self.add_directory(path=path + directory, recurse=True, delete_duplicate=delete_duplicate,
-                                   sort_files=sort_files, is_csv=is_csv)
-
+        logger.info(f"Building tree from {self.path}...")
+        self.progress = ScanProgress(callback=self.progress.callback, interval=self.progress.interval)
+        if is_csv and self.cache is None:
+            self.add_takeout_directory(path=self.path, recurse=recurse, delete_duplicate=delete_duplicate,
+                                       sort_files=sort_files, workers=workers)
+        elif workers is None and self.cache is None:
+            self.add_directory(path=self.path, recurse=recurse, delete_duplicate=delete_duplicate,
+                               sort_files=sort_files, is_csv=is_csv)
+        else:
+            self.add_directory_parallel(path=self.path, recurse=recurse, delete_duplicate=delete_duplicate,
+                                        sort_files=sort_files, is_csv=is_csv, workers=workers,
+                                        use_processes=use_processes)
+            if self.cache is not None:
+                if recurse:
+                    logger.info(f"Dropped {self.cache.prune(self.path)} deleted files from the tag cache.")
+                self.cache.save()
+        self.progress.finish('populate')
+
+    def find_songs(self, path, recurse: bool = False, is_csv: bool = False):
+        """
+        Yields an os.DirEntry for every song under path, in the order the tree is built: the contents of each
+        subdirectory first, then the files in the directory itself.
+        """
+        logger.debug(f"Adding directory: {path}")
         if is_csv:
             allowed = ['csv']
         else:
             allowed = song_filetypes
+        return walk_files(path, extensions=allowed, recurse=recurse)
 
-        for song in filter(lambda f: get_filetype(f) in allowed, os.listdir(path)):
-            self.add_song(path=path, filename=song, delete_duplicate=delete_duplicate, sort_files=sort_files,
-                          is_csv=is_csv)
+    def add_directory(self, path, recurse: bool = False, delete_duplicate: bool = False, sort_files: bool = False,
+                      is_csv: bool = False):
+        progress = self.progress
+        for song in progress.timed('walk', self.find_songs(path=path, recurse=recurse, is_csv=is_csv)):
+            with progress.timer('tags'):
+                tags = read_tags(song.path, is_csv=is_csv)
+            size = song.stat().st_size
+            progress.update(bytes_read=size)
+            with progress.timer('insert'):
+                self.add_song(path=os.path.dirname(song.path), filename=song.name, delete_duplicate=delete_duplicate,
+                              sort_files=sort_files, is_csv=is_csv, tags=tags, size=size)
+
+    def add_directory_parallel(self, path, recurse: bool = False, delete_duplicate: bool = False,
+                               sort_files: bool = False, is_csv: bool = False, workers: int = 4,
+                               use_processes: bool = False):
+        """
+        Collects every candidate path first, reads the tags on a pool of workers, then inserts the songs into the tree
+        on this thread in the same order as add_directory, so that the resulting tree is identical. Files found
+        unchanged in the tag cache are not read at all.
+        :param workers: Number of threads (or processes) to read tags with; if None, tags are read on this thread.
+        :param use_processes: Use a process pool; worth it when tag parsing rather than disk access is the bottleneck.
+        """
+        progress = self.progress
+        with progress.timer('walk'):
+            songs = list(self.find_songs(path=path, recurse=recurse, is_csv=is_csv))
+            paths = [song.path for song in songs]
+            stats = {}
+            for song in songs:
+                stat = song.stat()
+                stats[song.path] = (stat.st_mtime, stat.st_size)
+        all_tags = [None] * len(paths)
+        if self.cache is None:
+            to_read = paths
+        else:
+            to_read = []
+            for i, file in enumerate(paths):
+                all_tags[i] = self.cache.get(file, *stats[file])
+                if all_tags[i] is None:
+                    to_read.append(file)
+            progress.cached = len(paths) - len(to_read)
+            logger.info(f"{progress.cached} of {len(paths)} files unchanged since last scan.")
+
+        if workers is None:
+            executor = None
+            read = map(read_tags, to_read, [is_csv] * len(to_read))
+        else:
+            if use_processes:
+                executor = ProcessPoolExecutor(max_workers=workers)
+                chunksize = max(1, len(to_read) // (workers * 16))
+            else:
+                executor = ThreadPoolExecutor(max_workers=workers)
+                chunksize = 1
+            logger.info(f"Reading tags of {len(to_read)} files with {workers} workers...")
+            read = executor.map(read_tags, to_read, [is_csv] * len(to_read), chunksize=chunksize)
+
+        try:
+            for song, file, tags in zip(songs, paths, all_tags):
+                if tags is None:
+                    with progress.timer('tags'):
+                        tags = next(read)
+                    progress.update(bytes_read=stats[file][1])
+                    if self.cache is not None:
+                        self.cache.put(file, *stats[file], tags=tags)
+                else:
+                    progress.update()
+                with progress.timer('insert'):
+                    self.add_song(path=os.path.dirname(file), filename=song.name, delete_duplicate=delete_duplicate,
+                                  sort_files=sort_files, is_csv=is_csv, tags=tags, size=stats[file][1])
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def add_takeout_directory(self, path, recurse: bool = False, delete_duplicate: bool = False,
+                              sort_files: bool = False, workers: int = None):
+        """
+        Bulk ingestion for 'takeout csv' libraries: the per-track csvs are read on a pool of threads with
+        read_takeout_row, and each row goes straight into the tree as a compact Song, with no tag dicts built.
+        :param workers: Number of threads reading files; if None, they are read on this thread.
+        """
+        progress = self.progress
+        with progress.timer('walk'):
+            files = list(self.find_songs(path=path, recurse=recurse, is_csv=True))
+        paths = [file.path for file in files]
+        if workers is None:
+            executor = None
+            rows = map(read_takeout_row, paths)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+            logger.info(f"Reading {len(paths)} Takeout csvs with {workers} workers...")
+            rows = executor.map(read_takeout_row, paths, chunksize=64)
+        try:
+            for file in files:
+                with progress.timer('tags'):
+                    title, album, artist = next(rows)
+                size = file.stat().st_size
+                progress.update(bytes_read=size)
+                with progress.timer('insert'):
+                    # Interned through first_value, as the tags of audio files are
+                    artist = Song.first_value([artist])
+                    song = Song.from_core(file.path, core=(artist, artist, Song.first_value([album]),
+                                                           Song.first_value([title])), is_csv=True, size=size)
+                    self.insert_song(song, path=file.path, filename=file.name, delete_duplicate=delete_duplicate,
+                                     sort_files=sort_files)
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
     def add_song(self, path: str, filename: str, delete_duplicate: bool = False, sort_files: bool = False,
-                 is_csv: bool = False):
-        print('Adding song:', path + "\\" + filename)
+                 is_csv: bool = False, tags: dict = None, size: int = None):
         path = check_trailing_slash(path) + filename
-        song = Song(path, is_csv=is_csv)
+        logger.debug(f"Adding song: {path}")
+        song = Song(path, is_csv=is_csv, tags=tags, size=size)
+        return self.insert_song(song, path=path, filename=filename, delete_duplicate=delete_duplicate,
+                                sort_files=sort_files)
 
-        if song.tags.get('ARTIST') in [None, [], [""]]:
-            if song.tags.get('ALBUMARTIST') in [None, [], [""]]:
+    def insert_song(self, song: 'Song', path: str, filename: str, delete_duplicate: bool = False,
+                    sort_files: bool = False):
+        """
+        :return: The song, which is only part of the tree if no song with the same title was already in its album.
+        """
+        artist = song.get_tag('ARTIST')
+        if artist is None:
+            artist = song.get_tag('ALBUMARTIST')
+            if artist is None:
                 artist = 'None'
-            else:
-                artist = song.tags['ALBUMARTIST'][0]
-        else:
-            artist = song.tags['ARTIST'][0]
         song.artist = artist
         if self.artists.get(artist) is None:
             self.artists[artist] = ArtistDictTree(title=artist, sort_files=sort_files,
-                                                  path=self.path)
+                                                  path=self.path, transfers=self.transfers)
         self.artists[artist].add_song(song, path=path, filename=filename, delete_duplicate=delete_duplicate,
                                       sort_files=sort_files)
+        return song
+
+    def remove_song(self, artist: str, album: str, title: str):
+        """
+        Removes a song from the tree (not from disk), dropping its album and artist if they are left empty.
+        """
+        artist_tree = self.artists[artist]
+        album_tree = artist_tree[album]
+        del album_tree.songs[title]
+        if len(album_tree) == 0:
+            del artist_tree.albums[album]
+            if len(artist_tree) == 0:
+                del self.artists[artist]
+        self.num_tracks -= 1
+
+    def watch(self, interval: float = 5.0, use_inotify: bool = None):
+        """
+        Starts keeping the tree up to date with changes on disk in a background thread; see LibraryWatcher.
+        :return: The running LibraryWatcher; call its stop method to end it.
+        """
+        watcher = LibraryWatcher(self, interval=interval, use_inotify=use_inotify)
+        watcher.start()
+        return watcher
+
+    def to_columnar(self):
+        return ColumnarLibrary.from_tree(self)
+
+    def save_snapshot(self, path: str):
+        """
+        Saves the tree to a binary snapshot file; see ColumnarLibrary.save.
+        """
+        self.to_columnar().save(path)
+
+    @classmethod
+    def load_snapshot(cls, path: str):
+        """
+        Loads a tree saved with save_snapshot, without reading any audio files.
+        """
+        return ColumnarLibrary.load(path).to_tree()
+
+    def iter_songs(self):
+        for artist in self.artists.values():
+            for album in artist.albums.values():
+                yield from album.songs.values()
+
+    def find_duplicates(self, workers: int = 4, audio: bool = False):
+        """
+        Finds duplicate audio files anywhere in the library, including across albums and artists, by content rather
+        than by title. If the tree was scanned from its path, the files on disk are checked (including those left out of
+        the tree as title duplicates); otherwise, as for a comparison tree, only the songs in the tree are.
+        :param audio: Compare only the audio streams, ignoring differences in tags.
+        :return: List of clusters of paths to identical files.
+        """
+        if self.path is not None and self.type not in ('takeout csv', 'comparison'):
+            paths = [song.path for song in self.find_songs(self.path, recurse=True)]
+        else:
+            paths = [song.path for song in self.iter_songs()]
+        clusters = find_duplicate_files(paths, workers=workers, audio=audio)
+        logger.info(f"Found {len(clusters)} sets of duplicate files.")
+        return clusters
+
+    def delete_duplicates(self, clusters: list):
+        """
+        Deletes all but one file from each cluster returned by find_duplicates. The copy that is part of the tree is
+        kept where there is one, otherwise the first; songs whose files are deleted are removed from the tree with
+        remove_song, so albums and artists left empty are dropped too.
+        """
+        in_tree = {}
+        for artist_title, artist in self.artists.items():
+            for album_title, album in artist.albums.items():
+                for title, song in album.songs.items():
+                    in_tree[song.path] = (artist_title, album_title, title)
+        for cluster in clusters:
+            keep = next((path for path in cluster if path in in_tree), cluster[0])
+            for path in cluster:
+                if path != keep:
+                    delete_file(path)
+                    if path in in_tree:
+                        self.remove_song(*in_tree.pop(path))
 
     def show_artists(self):
         for artist in self.artists:
@@ -148,46 +814,76 @@ class SongDictTree:
         self.num_tracks = num
         return num
 
-    def compare(self, other: 'SongDictTree', copy: bool = False):
+    def index(self, key=None):
+        """
+        Flattens the tree into a dict of (artist, album, title) keys, each mapping to a list of the names of the songs
+        filed under that key in this tree.
+        :param key: Function applied to each (artist, album, title) tuple to give the key; if None, the tuple is used
+            as is. Songs that give the same key are all kept, in tree order.
+        """
+        index = {}
+        for artist_name, artist in self.artists.items():
+            for album_name, album in artist.albums.items():
+                for title in album.songs:
+                    names = (artist_name, album_name, title)
+                    if key is None:
+                        index[names] = [names]
+                    else:
+                        index.setdefault(key(names), []).append(names)
+        return index
+
+    def diff(self, other: 'SongDictTree', match: str = 'exact', threshold: float = 0.85):
+        """
+        :param match: 'exact' compares tag strings as they are; 'normalised' compares them after normalise_name, so
+            that case, punctuation, articles and release suffixes are ignored; 'fuzzy' also pairs up the remaining
+            songs whose normalised names are similar.
+        :param threshold: Minimum similarity, between 0 and 1, for a fuzzy match.
+        """
+        if match not in match_modes:
+            raise ValueError("Only match modes ", match_modes, "accepted.")
+        if match == 'exact':
+            return LibraryDiff(self, other)
+        elif match == 'normalised':
+            return LibraryDiff(self, other, key=normalise_key)
+        else:
+            return LibraryDiff(self, other, key=normalise_key, threshold=threshold)
+
+    def compare(self, other: 'SongDictTree', copy: bool = False, match: str = 'exact', threshold: float = 0.85,
+                workers: int = 4, dry_run: bool = False):
         """
         Returns a new SongDictTree containing the artists present in this tree but missing in the other, etc.
         :param other:
+        :param copy: Copy the missing songs into the other library's directory.
+        :param match: How tags are matched between the libraries; see diff.
+        :param threshold: Minimum similarity for fuzzy matching.
+        :param workers: Number of files copied at once.
+        :param dry_run: Only print the copies that would be made.
         :return:
         """
-        if copy:
-            path = other.path
-            sort_files = True
-        else:
-            path = None
-            sort_files = False
-        missing_artists = SongDictTree(library_type='comparison', path=path, sort_files=sort_files, populate=False)
-        for artist_name in self.artists:
-            artist = self.artists[artist_name]
-            print("Searching for artist", artist.title)
-            if other.get(artist.title) is None:
-                print("Artist not found. Adding to difference. Copy is", copy)
-                missing_artists[artist.title] = artist.__copy__(path=other.path, sort_files=copy)
-            else:
-                print("Artist found. Looking for missing albums.")
-                missing_albums = artist.compare(other[artist.title], copy=copy)
-                if len(missing_albums) > 0:
-                    missing_artists[artist.title] = missing_albums
-        missing_artists.count_songs()
-        return missing_artists
+        diff = self.diff(other, match=match, threshold=threshold)
+        logger.info(diff)
+        return diff.tree(copy=copy, workers=workers, dry_run=dry_run)
 
     def csv(self):
-        rows = []
-        for artist in self.artists:
-            artist = self.artists[artist]
-            rows.extend(artist.csv())
-        return rows
+        return list(self.iter_csv())
+
+    def iter_csv(self, sort: bool = False):
+        """
+        Yields the csv rows of every song in the tree without building the full list.
+        :param sort: Walk artists and albums in sorted order, giving the same row order as sorting the output of csv()
+            by artist and album.
+        """
+        if sort:
+            artists = sorted(self.artists)
+        else:
+            artists = self.artists
+        for artist in artists:
+            yield from self.artists[artist].iter_csv(sort=sort)
 
     def write_csv(self, path):
         path += '_' + str(self.num_tracks)
         if path[-4:] != '.csv':
             path += '.csv'
-        rows = self.csv()
-        rows.sort(key=lambda r: (r[0], r[1]))
         header = ['Artist', 'Album', 'Title', 'Path']
         # writing to csv file
         with open(path, 'w', newline='', encoding="utf-8") as csv_file:
@@ -195,22 +891,758 @@ class SongDictTree:
             csv_writer = csv.writer(csv_file)
             # writing the fields
             csv_writer.writerow(header)
-            # writing the data rows
-            csv_writer.writerows(rows)
+            # streaming the data rows, already in sorted order
+            csv_writer.writerows(self.iter_csv(sort=True))
+
+
+class FuzzyIndex:
+    def __init__(self, keys, n: int = 3):
+        """
+        An approximate-match index over (artist, album, title) keys. Candidates are found by the character n-grams
+        they share with the query (blocking), so only those are scored rather than every key in the index.
+        :param keys: The keys to index, usually already normalised.
+        :param n: Length of the n-grams.
+        """
+        self.n = n
+        self.keys = list(keys)
+        self.strings = ['\x1f'.join(k) for k in self.keys]
+        self.grams = {}
+        self.sizes = []
+        for i, string in enumerate(self.strings):
+            grams = self.ngrams(string)
+            self.sizes.append(len(grams))
+            for gram in grams:
+                self.grams.setdefault(gram, []).append(i)
+
+    def ngrams(self, string: str):
+        string = f" {string} "
+        return {string[i:i + self.n] for i in range(max(1, len(string) - self.n + 1))}
+
+    def match(self, key, threshold: float = 0.85, exclude=()):
+        """
+        :param exclude: Keys in the index not to match, eg those already paired with another query.
+        :return: The most similar key in the index with a similarity of at least threshold, or None. Of equally similar
+            keys, the one indexed first is returned, so that the result does not depend on hash ordering.
+        """
+        string = '\x1f'.join(key)
+        grams = self.ngrams(string)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.grams.get(gram, ()))
+        best = None
+        best_score = threshold
+        for i, count in shared.items():
+            # Only score candidates whose n-gram sets overlap enough (Dice coefficient) to plausibly match.
+            if 2 * count / (len(grams) + self.sizes[i]) < threshold * 0.75:
+                continue
+            if self.keys[i] in exclude:
+                continue
+            score = SequenceMatcher(None, string, self.strings[i]).ratio()
+            if score > best_score or (score == best_score and (best is None or i < best)):
+                best = i
+                best_score = score
+        return self.keys[best] if best is not None else None
+
+
+class LibraryDiff:
+    def __init__(self, source: SongDictTree, target: SongDictTree, key=None, threshold: float = None):
+        """
+        The difference between two libraries, computed in bulk on their flattened key indices rather than by walking
+        both trees.
+        :param source: The library being checked.
+        :param target: The library being checked against.
+        :param key: Key function passed to SongDictTree.index. missing, extra and common are lists of keys; every song
+            under a key shares its fate.
+        :param threshold: If given, songs left unmatched are paired up with a FuzzyIndex at this similarity; the pairs
+            are kept in matches.
+        """
+        self.source = source
+        self.target = target
+        self.source_index = source.index(key=key)
+        self.target_index = target.index(key=key)
+        missing = self.source_index.keys() - self.target_index.keys()
+        extra = self.target_index.keys() - self.source_index.keys()
+        # Filter rather than iterate over the sets, to keep the order of each tree.
+        self.matches = {}
+        if threshold is not None and missing and extra:
+            # Built in the target's order, so that ties are broken the same way on every run
+            index = FuzzyIndex([k for k in self.target_index if k in extra])
+            matched = set()
+            for k in self.source_index:
+                if k in missing:
+                    match = index.match(k, threshold=threshold, exclude=matched)
+                    if match is not None:
+                        self.matches[k] = match
+                        matched.add(match)
+                        missing.discard(k)
+                        extra.discard(match)
+        self.missing = [k for k in self.source_index if k in missing]
+        self.extra = [k for k in self.target_index if k in extra]
+        self.common = [k for k in self.source_index if k not in missing]
+
+    def __len__(self):
+        return self.count(self.missing, self.source_index)
+
+    def __str__(self):
+        return (f"{len(self)} songs missing, {self.count(self.extra, self.target_index)} extra, "
+                f"{self.count(self.common, self.source_index)} in common.")
+
+    @staticmethod
+    def count(keys, index):
+        """
+        :return: The number of songs under keys, which can be more than one per key when names are normalised.
+        """
+        return sum(len(index[k]) for k in keys)
+
+    def missing_songs(self):
+        for key in self.missing:
+            for artist, album, title in self.source_index[key]:
+                yield self.source[artist][album][title]
+
+    def extra_songs(self):
+        for key in self.extra:
+            for artist, album, title in self.target_index[key]:
+                yield self.target[artist][album][title]
+
+    def tree(self, copy: bool = False, workers: int = 4, dry_run: bool = False):
+        """
+        Builds the tree-shaped result of SongDictTree.compare: a 'comparison' tree holding the songs missing from the
+        target, with each artist and album given the path it has (or would have) in the target library.
+        :param copy: Copy the missing songs into the target library. Files are always copied, never moved.
+        :param workers: Number of files copied at once.
+        :param dry_run: Only print the copies that would be made.
+        """
+        if copy:
+            path = self.target.path
+        else:
+            path = None
+        missing_artists = SongDictTree(library_type='comparison', path=path, sort_files=copy, populate=False)
+        target_path = check_trailing_slash(self.target.path)
+        for artist_name, album_name, title in (names for key in self.missing for names in self.source_index[key]):
+            song = self.source[artist_name][album_name][title]
+            other_artist = self.target.get(artist_name)
+            artist = missing_artists.get(artist_name)
+            if artist is None:
+                if other_artist is None:
+                    artist = ArtistDictTree(title=artist_name, path=target_path, sort_files=copy,
+                                            transfers=missing_artists.transfers)
+                else:
+                    artist = ArtistDictTree(title=artist_name, path=other_artist.path, sort_files=copy,
+                                            transfers=missing_artists.transfers)
+                missing_artists[artist_name] = artist
+            album = artist.get(album_name)
+            if album is None:
+                if other_artist is not None and other_artist.get(album_name) is not None:
+                    album_path = other_artist[album_name].path
+                else:
+                    album_path = artist.path + sanitise_path(album_name)
+                album = AlbumDictTree(title=album_name, artist=artist_name, path=album_path, sort_files=copy,
+                                      transfers=missing_artists.transfers)
+                artist[album_name] = album
+            album.add_song(song, path=song.path, set_title=True, sort_files=copy, move=False)
+        if copy:
+            missing_artists.transfers.execute(workers=workers, dry_run=dry_run, progress=self.source.progress)
+        missing_artists.count_songs()
+        return missing_artists
+
+
+class LibraryWatcher:
+    def __init__(self, tree: SongDictTree, interval: float = 5.0, use_inotify: bool = None):
+        """
+        Keeps a populated SongDictTree in step with its directory: files that are created, deleted, moved or modified
+        are applied to the tree one at a time, without a full rescan. Changes are picked up from inotify events where
+        the inotify_simple package is available, in which case only the directories the events came from are rescanned;
+        otherwise the library is rescanned with os.scandir every interval and compared with the previous scan.
+        The tree can be queried as usual while it is watched; hold lock while iterating over it.
+        :param interval: Seconds between scans when polling, or the longest wait for events with inotify.
+        :param use_inotify: Whether to use inotify; by default, it is used if available.
+        """
+        if tree.path is None:
+            raise ValueError("Only trees built from a path can be watched.")
+        if use_inotify is None:
+            use_inotify = INotify is not None
+        elif use_inotify and INotify is None:
+            raise ImportError("inotify_simple is required to watch with inotify.")
+        self.tree = tree
+        self.interval = interval
+        self.is_csv = tree.type == 'takeout csv'
+        if self.is_csv:
+            self.extensions = ['csv']
+        else:
+            self.extensions = song_filetypes
+        self.lock = threading.RLock()
+        self.paths = {}
+        # Files left out of the tree because their album already has a song with the same title.
+        self.duplicates = {}
+        for artist_name, artist in tree.artists.items():
+            for album_name, album in artist.albums.items():
+                for title, song in album.songs.items():
+                    self.paths[song.path] = (artist_name, album_name, title)
+        self.snapshot = {}
+        self.inotify = None
+        self.watches = {}
+        if use_inotify:
+            self.inotify = INotify()
+        self.discover(os.path.normpath(tree.path), initial=True)
+        for files in self.snapshot.values():
+            for path in files:
+                if path not in self.paths:
+                    # Left out of the tree when it was built; its tags are only read if it is needed.
+                    self.duplicates[path] = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def scan_directory(self, directory: str):
+        """
+        :return: ({path: (mtime, size)} for the songs directly in directory, [subdirectories]).
+        :raises FileNotFoundError, NotADirectoryError: If directory has gone.
+        """
+        subdirectories = []
+        files = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                else:
+                    files.append(entry)
+        return self.stat_songs(files), subdirectories
+
+    def stat_songs(self, entries):
+        """
+        :return: {path: (mtime, size)} for the songs among entries, leaving out any deleted since they were listed.
+        """
+        songs = {}
+        for entry in entries:
+            if get_filetype(entry.name) in self.extensions:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                songs[entry.path] = (stat.st_mtime, stat.st_size)
+        return songs
+
+    def walk(self, directory: str):
+        """
+        walk_directories, skipping directories that are deleted during the walk.
+        """
+        return walk_directories(directory, onerror=lambda e: logger.debug(f"Watcher skipping {e.filename}: {e}"))
+
+    def add_watch(self, directory: str):
+        if self.inotify is not None:
+            mask = (inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.CLOSE_WRITE |
+                    inotify_flags.MOVED_FROM | inotify_flags.MOVED_TO | inotify_flags.ATTRIB)
+            try:
+                self.watches[self.inotify.add_watch(directory, mask)] = directory
+            except (FileNotFoundError, NotADirectoryError):
+                # Deleted since it was scanned; its parent's events will have it forgotten.
+                pass
+
+    def discover(self, directory: str, initial: bool = False):
+        """
+        Scans a directory that is new to the watcher, and everything under it.
+        :param initial: The songs found are already in the tree, so are only recorded.
+        """
+        for path, subdirectories, files in self.walk(directory):
+            path = os.path.normpath(path)
+            self.snapshot[path] = self.stat_songs(files)
+            if not initial:
+                for file, stat in self.snapshot[path].items():
+                    self.add(file, stat[1])
+            self.add_watch(path)
+
+    def forget(self, directory: str):
+        """
+        Drops a directory that has been deleted or moved away, and everything under it.
+        """
+        files = []
+        for path in [d for d in self.snapshot if d == directory or d.startswith(directory + os.sep)]:
+            files.extend(self.snapshot.pop(path))
+        # Drop the duplicates first, so that none of them are put in the place of a removed song.
+        for file in files:
+            self.duplicates.pop(file, None)
+        for file in files:
+            self.remove(file)
+
+    def refresh(self, directory: str):
+        """
+        Rescans a single directory and applies any changes to its songs; subdirectories that have appeared or
+        disappeared are discovered or forgotten whole.
+        """
+        try:
+            files, subdirectories = self.scan_directory(directory)
+        except (FileNotFoundError, NotADirectoryError):
+            self.forget(directory)
+            return
+        self.apply(self.snapshot.get(directory, {}), files)
+        self.snapshot[directory] = files
+        for subdirectory in subdirectories:
+            if os.path.normpath(subdirectory) not in self.snapshot:
+                self.discover(subdirectory)
+        subdirectories = {os.path.normpath(d) for d in subdirectories}
+        for known in [d for d in self.snapshot if os.path.dirname(d) == directory and d != directory]:
+            if known not in subdirectories:
+                self.forget(known)
+
+    def poll(self):
+        """
+        Rescans the whole library and applies the differences from the last scan.
+        """
+        with self.lock:
+            if not os.path.isdir(self.tree.path):
+                # Most likely an unmounted drive, which is not the same as every song having been deleted.
+                logger.warning(f"Watcher cannot find {self.tree.path}; leaving the tree as it is.")
+                return
+            current = {}
+            for path, subdirectories, files in self.walk(self.tree.path):
+                path = os.path.normpath(path)
+                current[path] = self.stat_songs(files)
+                if path not in self.snapshot:
+                    # Only after an inotify queue overflow, when directories may have appeared unnoticed.
+                    self.add_watch(path)
+            for directory in self.snapshot.keys() | current.keys():
+                self.apply(self.snapshot.get(directory, {}), current.get(directory, {}))
+            self.snapshot = current
+            self.tree.count_songs()
+
+    def apply(self, old: dict, new: dict):
+        for path in old.keys() - new.keys():
+            self.remove(path)
+        for path, stat in new.items():
+            if path not in old:
+                self.add(path, stat[1])
+            elif old[path] != stat:
+                self.remove(path)
+                self.add(path, stat[1])
+
+    def add(self, path: str, size: int = None):
+        try:
+            tags = read_tags(path, is_csv=self.is_csv)
+        except Exception as e:
+            # Most likely a file still being written; it will be retried when it is next modified.
+            logger.warning(f"Could not read tags from {path}: {e}")
+            return
+        logger.debug(f"Watcher adding song: {path}")
+        song = self.tree.add_song(path=os.path.dirname(path), filename=os.path.basename(path), is_csv=self.is_csv,
+                                  tags=tags, size=size)
+        names = (song.artist, song.album, song.title)
+        if self.tree[song.artist][song.album].get(song.title) is song:
+            self.paths[path] = names
+        else:
+            self.duplicates[path] = names
+
+    def remove(self, path: str):
+        if self.duplicates.pop(path, None) is not None:
+            return
+        names = self.paths.pop(path, None)
+        if names is not None:
+            logger.debug(f"Watcher removing song: {path}")
+            self.tree.remove_song(*names)
+            # A file that was left out as a duplicate of this one can now take its place.
+            for duplicate, duplicate_names in list(self.duplicates.items()):
+                if not os.path.exists(duplicate):
+                    del self.duplicates[duplicate]
+                    continue
+                if duplicate_names is None:
+                    try:
+                        song = Song(duplicate, is_csv=self.is_csv)
+                    except Exception as e:
+                        logger.warning(f"Could not read tags from {duplicate}: {e}")
+                        del self.duplicates[duplicate]
+                        continue
+                    artist = song.get_tag('ARTIST') or song.get_tag('ALBUMARTIST') or 'None'
+                    title = song.get_tag('TITLE') or os.path.basename(duplicate)
+                    duplicate_names = (artist, song.get_tag('ALBUM') or 'None', title)
+                    self.duplicates[duplicate] = duplicate_names
+                if duplicate_names == names:
+                    del self.duplicates[duplicate]
+                    self.add(duplicate)
+                    break
+
+    def process_events(self, timeout: float = None):
+        """
+        Waits up to timeout seconds for inotify events, then rescans the directories they came from.
+        """
+        if timeout is None:
+            timeout = self.interval
+        dirty = set()
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & inotify_flags.Q_OVERFLOW:
+                # Events have been lost, so nothing short of a full rescan can be trusted.
+                logger.warning("Watcher inotify queue overflowed; rescanning the library.")
+                self.poll()
+                return
+            directory = self.watches.get(event.wd)
+            if event.mask & inotify_flags.IGNORED:
+                self.watches.pop(event.wd, None)
+            elif directory is not None:
+                dirty.add(directory)
+        if dirty:
+            with self.lock:
+                for directory in dirty:
+                    self.refresh(directory)
+                self.tree.count_songs()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                if self.inotify is not None:
+                    self.process_events()
+                else:
+                    if self.stopping.wait(self.interval):
+                        break
+                    self.poll()
+            except Exception:
+                # The thread must outlive any one bad change, or the tree silently stops updating.
+                logger.exception("Watcher failed to apply changes; continuing.")
+                if self.inotify is not None and self.stopping.wait(self.interval):
+                    break
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+class ColumnarLibrary:
+    def __init__(self, artist_names: list, album_names: list, filetype_names: list, artist_ids, album_ids,
+                 filetype_ids, titles: list, paths: list, sizes, library_type: str = 'comparison', path: str = None):
+        """
+        A library stored as columns rather than nested dicts of objects: one row per song, with artist, album and
+        filetype dictionary-encoded as integer ids into lists of names. Counts, group-bys and exports work on whole
+        columns at once; __getitem__ and get give the same artist -> album -> song access as SongDictTree, through
+        views built on demand.
+        :param artist_names: The distinct artist names; artist_ids index into this.
+        :param album_names: The distinct album names (an album id does not identify an artist).
+        :param filetype_names: The distinct filetypes.
+        :param sizes: File sizes in bytes, -1 where unknown.
+        """
+        self.artist_names = list(artist_names)
+        self.album_names = list(album_names)
+        self.filetype_names = list(filetype_names)
+        self.artist_ids = np.asarray(artist_ids, dtype=np.int32)
+        self.album_ids = np.asarray(album_ids, dtype=np.int32)
+        self.filetype_ids = np.asarray(filetype_ids, dtype=np.int16)
+        self.titles = titles
+        self.paths = paths
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.type = library_type
+        self.path = path
+        self.num_tracks = len(self.titles)
+        # Timings of transfers made from this library, as for SongDictTree.
+        self.progress = ScanProgress()
+        self._groups = None
+        self._artists = None
+
+    @classmethod
+    def from_tree(cls, tree: SongDictTree):
+        artist_codes = {}
+        album_codes = {}
+        filetype_codes = {}
+        artist_ids = []
+        album_ids = []
+        filetype_ids = []
+        titles = []
+        paths = []
+        sizes = []
+        for artist_name, artist in tree.artists.items():
+            artist_id = artist_codes.setdefault(artist_name, len(artist_codes))
+            for album_name, album in artist.albums.items():
+                album_id = album_codes.setdefault(album_name, len(album_codes))
+                for title, song in album.songs.items():
+                    artist_ids.append(artist_id)
+                    album_ids.append(album_id)
+                    filetype_ids.append(filetype_codes.setdefault(song.filetype, len(filetype_codes)))
+                    titles.append(title)
+                    paths.append(song.path)
+                    sizes.append(-1 if song.size is None else song.size)
+        return cls(artist_names=list(artist_codes), album_names=list(album_codes),
+                   filetype_names=list(filetype_codes), artist_ids=artist_ids, album_ids=album_ids,
+                   filetype_ids=filetype_ids, titles=titles, paths=paths, sizes=sizes, library_type=tree.type,
+                   path=tree.path)
+
+    def to_tree(self):
+        """
+        Builds a SongDictTree holding the same songs, without reading any files.
+        """
+        tree = SongDictTree(library_type=self.type, populate=False)
+        tree.path = self.path
+        is_csv = self.type == 'takeout csv'
+        artist_names = np.array(self.artist_names, dtype=object)[self.artist_ids].tolist()
+        album_names = np.array(self.album_names, dtype=object)[self.album_ids].tolist()
+        filetypes = np.array(self.filetype_names, dtype=object)[self.filetype_ids].tolist()
+        artist = album = None
+        for artist_name, album_name, title, path, filetype, size in zip(artist_names, album_names, self.titles,
+                                                                         self.paths, filetypes, self.sizes.tolist()):
+            if artist is None or artist.title != artist_name:
+                artist = tree.get(artist_name)
+                if artist is None:
+                    artist = ArtistDictTree(title=artist_name, path=self.path or "", transfers=tree.transfers)
+                    tree[artist_name] = artist
+                album = None
+            if album is None or album.title != album_name:
+                album = artist.get(album_name)
+                if album is None:
+                    album = AlbumDictTree(title=album_name, artist=artist_name,
+                                          path=artist.path + sanitise_path(album_name), transfers=tree.transfers)
+                    artist[album_name] = album
+            album.songs[title] = Song.from_columns(path, title, album_name, artist_name, filetype, is_csv, size)
+        tree.count_songs()
+        return tree
+
+    def __len__(self):
+        return self.num_tracks
+
+    def __getitem__(self, item):
+        return self.artists[item]
+
+    def get(self, item):
+        return self.artists.get(item)
+
+    def groups(self):
+        """
+        The row numbers of each (artist id, album id) pair, in row order; computed once with a stable sort.
+        """
+        if self._groups is None:
+            keys = self.artist_ids.astype(np.int64) * len(self.album_names) + self.album_ids
+            order = np.argsort(keys, kind='stable')
+            boundaries = np.flatnonzero(np.diff(keys[order])) + 1
+            self._groups = {}
+            for rows in np.split(order, boundaries):
+                if len(rows) > 0:
+                    self._groups[(int(self.artist_ids[rows[0]]), int(self.album_ids[rows[0]]))] = rows
+        return self._groups
+
+    @property
+    def artists(self):
+        if self._artists is None:
+            self._artists = {}
+            for artist_id, album_id in sorted(self.groups(), key=lambda k: self.groups()[k][0]):
+                artist_name = self.artist_names[artist_id]
+                if artist_name not in self._artists:
+                    self._artists[artist_name] = ColumnarArtistView(self, artist_id)
+                self._artists[artist_name].album_ids.append(album_id)
+        return self._artists
+
+    def index(self, key=None):
+        """
+        The flattened (artist, album, title) index used by LibraryDiff, as SongDictTree.index, read from the columns.
+        """
+        index = {}
+        artists = [self.artist_names[i] for i in self.artist_ids.tolist()]
+        albums = [self.album_names[i] for i in self.album_ids.tolist()]
+        for names in zip(artists, albums, self.titles):
+            if key is None:
+                index.setdefault(names, []).append(names)
+            else:
+                index.setdefault(key(names), []).append(names)
+        return index
+
+    def song(self, row: int):
+        return Song.from_columns(self.paths[row], self.titles[row], self.album_names[self.album_ids[row]],
+                                 self.artist_names[self.artist_ids[row]],
+                                 self.filetype_names[self.filetype_ids[row]], self.type == 'takeout csv',
+                                 int(self.sizes[row]))
+
+    def count_songs(self):
+        return self.num_tracks
+
+    def count_by_artist(self):
+        counts = np.bincount(self.artist_ids, minlength=len(self.artist_names))
+        return dict(zip(self.artist_names, counts.tolist()))
+
+    def count_by_album(self):
+        return {(self.artist_names[a], self.album_names[b]): len(rows) for (a, b), rows in self.groups().items()}
+
+    def size_by_artist(self):
+        sizes = np.bincount(self.artist_ids, weights=np.maximum(self.sizes, 0), minlength=len(self.artist_names))
+        return dict(zip(self.artist_names, sizes.astype(np.int64).tolist()))
+
+    def sorted_rows(self):
+        """
+        Row numbers ordered by artist and album name, keeping row order within an album, as in SongDictTree.write_csv.
+        """
+        artist_rank = np.argsort(np.argsort(np.array(self.artist_names, dtype=object), kind='stable'))
+        album_rank = np.argsort(np.argsort(np.array(self.album_names, dtype=object), kind='stable'))
+        return np.lexsort((np.arange(self.num_tracks), album_rank[self.album_ids], artist_rank[self.artist_ids]))
+
+    def iter_csv(self, sort: bool = False):
+        if sort:
+            rows = self.sorted_rows()
+        else:
+            rows = range(self.num_tracks)
+        for row in rows:
+            yield [self.artist_names[self.artist_ids[row]], self.album_names[self.album_ids[row]], self.titles[row],
+                   self.paths[row]]
+
+    def csv(self):
+        return list(self.iter_csv())
+
+    def write_csv(self, path):
+        path += '_' + str(self.num_tracks)
+        if path[-4:] != '.csv':
+            path += '.csv'
+        with open(path, 'w', newline='', encoding="utf-8") as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(['Artist', 'Album', 'Title', 'Path'])
+            csv_writer.writerows(self.iter_csv(sort=True))
+
+    def save(self, path: str):
+        """
+        Writes the library to a compact binary snapshot: a magic string and format version, a JSON header, then each
+        string column as NUL-separated UTF-8 and each id and size column as raw little-endian integers. No pickling is
+        involved, and loading is a single read followed by zero-copy array views.
+        """
+        header = json.dumps({'type': self.type, 'path': self.path, 'num_tracks': self.num_tracks}).encode('utf-8')
+        with open(path, 'wb') as file:
+            file.write(snapshot_magic)
+            file.write(struct.pack('<II', snapshot_version, len(header)))
+            file.write(header)
+            for strings in (self.artist_names, self.album_names, self.filetype_names, self.titles, self.paths):
+                data = '\x00'.join(strings).encode('utf-8')
+                file.write(struct.pack('<QQ', len(strings), len(data)))
+                file.write(data)
+            for array, dtype in ((self.artist_ids, '<i4'), (self.album_ids, '<i4'), (self.filetype_ids, '<i2'),
+                                 (self.sizes, '<i8')):
+                file.write(array.astype(dtype).tobytes())
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'rb') as file:
+            data = file.read()
+        if data[:len(snapshot_magic)] != snapshot_magic:
+            raise ValueError(f"{path} is not a library snapshot.")
+        position = len(snapshot_magic)
+        version, header_length = struct.unpack_from('<II', data, position)
+        if version != snapshot_version:
+            raise ValueError(f"Snapshot version {version} not supported; expected {snapshot_version}.")
+        position += 8
+        header = json.loads(data[position:position + header_length].decode('utf-8'))
+        position += header_length
+        columns = []
+        for i in range(5):
+            count, length = struct.unpack_from('<QQ', data, position)
+            position += 16
+            if count == 0:
+                columns.append([])
+            else:
+                columns.append(data[position:position + length].decode('utf-8').split('\x00'))
+            position += length
+        num_tracks = header['num_tracks']
+        arrays = []
+        for dtype in ('<i4', '<i4', '<i2', '<i8'):
+            array = np.frombuffer(data, dtype=dtype, count=num_tracks, offset=position)
+            position += array.nbytes
+            arrays.append(array)
+        artist_names, album_names, filetype_names, titles, paths = columns
+        artist_ids, album_ids, filetype_ids, sizes = arrays
+        return cls(artist_names=artist_names, album_names=album_names, filetype_names=filetype_names,
+                   artist_ids=artist_ids, album_ids=album_ids, filetype_ids=filetype_ids, titles=titles, paths=paths,
+                   sizes=sizes, library_type=header['type'], path=header['path'])
+
+    def to_dataframe(self):
+        """
+        Converts the library to a pandas DataFrame. Artist, album and filetype become categoricals over the existing
+        id arrays, so no per-row conversion is done.
+        """
+        import pandas as pd
+        return pd.DataFrame({'artist': pd.Categorical.from_codes(self.artist_ids, self.artist_names),
+                             'album': pd.Categorical.from_codes(self.album_ids, self.album_names),
+                             'title': self.titles,
+                             'path': self.paths,
+                             'filetype': pd.Categorical.from_codes(self.filetype_ids, self.filetype_names),
+                             'size': self.sizes})
+
+
+class ColumnarArtistView:
+    def __init__(self, library: ColumnarLibrary, artist_id: int):
+        """
+        Read-only view of one artist in a ColumnarLibrary, with the same access as ArtistDictTree. path is derived as
+        SongDictTree derives it for its artists, from the library's path.
+        """
+        self.library = library
+        self.artist_id = artist_id
+        self.title = library.artist_names[artist_id]
+        self.path = check_trailing_slash(library.path or "")
+        self.album_ids = []
+        self._albums = None
+
+    def __getitem__(self, item):
+        return self.albums[item]
+
+    def __len__(self):
+        return len(self.album_ids)
+
+    def get(self, item):
+        return self.albums.get(item)
+
+    @property
+    def albums(self):
+        if self._albums is None:
+            self._albums = {self.library.album_names[a]: ColumnarAlbumView(self.library, self.artist_id, a)
+                            for a in self.album_ids}
+        return self._albums
+
+    def count_songs(self):
+        return sum(len(self.library.groups()[(self.artist_id, a)]) for a in self.album_ids)
+
+
+class ColumnarAlbumView:
+    def __init__(self, library: ColumnarLibrary, artist_id: int, album_id: int):
+        """
+        Read-only view of one album in a ColumnarLibrary, with the same access as AlbumDictTree; Song objects are only
+        created when the songs are asked for. path is derived as ArtistDictTree derives it for its albums.
+        """
+        self.library = library
+        self.rows = library.groups()[(artist_id, album_id)]
+        self.title = library.album_names[album_id]
+        self.artist = library.artist_names[artist_id]
+        self.path = check_trailing_slash(check_trailing_slash(library.path or "") + sanitise_path(self.title))
+        self._songs = None
+
+    def __getitem__(self, item):
+        return self.songs[item]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, item):
+        return self.songs.get(item)
+
+    @property
+    def songs(self):
+        if self._songs is None:
+            self._songs = {self.library.titles[row]: self.library.song(row) for row in self.rows}
+        return self._songs
+
+    def count_songs(self):
+        return len(self.rows)
 
 
 class ArtistDictTree:
-    def __init__(self, title: str, path: str = "", sort_files: bool = False):
+    def __init__(self, title: str, path: str = "", sort_files: bool = False, transfers: TransferPlan = None):
         """
         :param title:
         :param path: The directory containing the albums by a certain artist.
+        :param transfers: The plan that directories to create and files to move are added to; shared with the rest of
+            the tree.
         """
         self.title = str(title)
         self.path = check_trailing_slash(path)
         self.albums = {}
+        if transfers is None:
+            transfers = TransferPlan()
+        self.transfers = transfers
         if sort_files:
-            if not os.path.isdir(path):
-                os.mkdir(path)
+            self.transfers.add_directory(self.path)
 
     def __getitem__(self, item):
         return self.albums[item]
@@ -221,16 +1653,17 @@ class ArtistDictTree:
     def __len__(self):
         return len(self.albums)
 
-    def __copy__(self, path: str = None, sort_files: bool = False):
+    def __copy__(self, path: str = None, sort_files: bool = False, move: bool = True, transfers: TransferPlan = None):
         if path is None:
             path = self.path
         else:
             path = check_trailing_slash(path)
 
-        copy = ArtistDictTree(title=self.title, path=path, sort_files=sort_files)
+        copy = ArtistDictTree(title=self.title, path=path, sort_files=sort_files, transfers=transfers)
         for album_name in self.albums:
             copy.albums[album_name] = self.albums[album_name].__copy__(path=path + sanitise_path(album_name),
-                                                                       sort_files=sort_files)
+                                                                       sort_files=sort_files, move=move,
+                                                                       transfers=copy.transfers)
         return copy
 
     def get(self, item):
@@ -238,14 +1671,13 @@ class ArtistDictTree:
 
     def add_song(self, song: 'Song', path: str, filename: str, delete_duplicate: bool = False,
                  sort_files: bool = False):
-        if song.tags.get('ALBUM') in [None, [], [""]]:
+        album = song.get_tag('ALBUM')
+        if album is None:
             album = 'None'
-        else:
-            album = song.tags['ALBUM'][0]
         song.album = album
         if self.get(album) is None:
             self[album] = AlbumDictTree(title=album, artist=self.title, sort_files=sort_files,
-                                        path=self.path + sanitise_path(album))
+                                        path=self.path + sanitise_path(album), transfers=self.transfers)
         self.albums[album].add_song(song, path=path, filename=filename, delete_duplicate=delete_duplicate,
                                     sort_files=sort_files)
 
@@ -270,55 +1702,68 @@ class ArtistDictTree:
             num += self[album].count_songs()
         return num
 
-    def compare(self, other: 'ArtistDictTree', copy: bool = False):
+    def compare(self, other: 'ArtistDictTree', copy: bool = False, transfers: TransferPlan = None):
         """
         Returns a new ArtistDictTree containing the albums present in this artist but missing in the other; it will also
         include albums present in both but missing songs in the other, with those songs listed.
         :param other:
+        :param transfers: Plan to add the copies to; if None, the copies are made before returning.
         :return:
         """
-        missing_albums = ArtistDictTree(self.title, path=other.path, sort_files=copy)
+        missing_albums = ArtistDictTree(self.title, path=other.path, sort_files=copy, transfers=transfers)
         for album_name in self.albums:
             album = self[album_name]
-            print("\tSearching for album", album.title, "in", self.title)
+            logger.debug(f"\tSearching for album {album.title} in {self.title}")
             if other.get(album.title) is None:
-                print("\tAlbum not found. Adding to difference. Copy is", copy)
+                logger.debug(f"\tAlbum not found. Adding to difference. Copy is {copy}")
                 missing_albums[album.title] = album.__copy__(path=other.path + sanitise_path(album.title),
-                                                             sort_files=copy)
+                                                             sort_files=copy, move=False,
+                                                             transfers=missing_albums.transfers)
                 # for song_name in album.songs:
                 #     song = album.songs[song_name]
                 #     print("\t\tAdding", song_name, "to difference. Copy is", copy)
                 #     missing_albums[album.title].add_song(song=song, path=song.path, sort_files=copy, move=False)
             else:
-                print("\tAlbum found. Looking for missing songs. Copy is", copy)
-                missing_songs = album.compare(other[album.title], copy=copy)
+                logger.debug(f"\tAlbum found. Looking for missing songs. Copy is {copy}")
+                missing_songs = album.compare(other[album.title], copy=copy, transfers=missing_albums.transfers)
                 if len(missing_songs) > 0:
                     missing_albums[album.title] = missing_songs
+        if copy and transfers is None:
+            missing_albums.transfers.execute()
         return missing_albums
 
     def csv(self):
-        rows = []
-        for album in self.albums:
-            album = self.albums[album]
-            rows.extend(album.csv())
-        return rows
+        return list(self.iter_csv())
+
+    def iter_csv(self, sort: bool = False):
+        if sort:
+            albums = sorted(self.albums)
+        else:
+            albums = self.albums
+        for album in albums:
+            yield from self.albums[album].iter_csv()
 
 
 class AlbumDictTree:
-    def __init__(self, title: str, artist: str = "", path: str = "", sort_files: bool = False):
+    def __init__(self, title: str, artist: str = "", path: str = "", sort_files: bool = False,
+                 transfers: TransferPlan = None):
         """
 
         :param title:
         :param path: The directory containing the songs of an album.
+        :param transfers: The plan that directories to create and files to move are added to; shared with the rest of
+            the tree.
         """
         self.title = str(title)
         self.path = check_trailing_slash(path)
         self.artist = artist
         self.songs = {}
+        if transfers is None:
+            transfers = TransferPlan()
+        self.transfers = transfers
 
         if sort_files:
-            if not os.path.isdir(path):
-                os.mkdir(path)
+            self.transfers.add_directory(self.path)
 
     def __getitem__(self, item):
         return self.songs[item]
@@ -329,15 +1774,16 @@ class AlbumDictTree:
     def __len__(self):
         return len(self.songs)
 
-    def __copy__(self, path: str = None, sort_files: bool = False):
+    def __copy__(self, path: str = None, sort_files: bool = False, move: bool = True, transfers: TransferPlan = None):
         if path is None:
             path = self.path
         else:
             path = check_trailing_slash(path)
-        copy = AlbumDictTree(title=self.title, artist=self.artist, path=path, sort_files=sort_files)
+        copy = AlbumDictTree(title=self.title, artist=self.artist, path=path, sort_files=sort_files,
+                             transfers=transfers)
         for song_name in self.songs:
             song = self.songs[song_name]
-            copy.add_song(song=song, path=song.path, sort_files=sort_files)
+            copy.add_song(song=song, path=song.path, sort_files=sort_files, move=move)
         return copy
 
     def get(self, item):
@@ -349,29 +1795,25 @@ class AlbumDictTree:
             filename = get_filename(path)
 
         if set_title:
-            if song.tags.get('TITLE') in [None, [], [""]]:
+            title = song.get_tag('TITLE')
+            if title is None:
                 title = filename
-            else:
-                title = song.tags['TITLE'][0]
             song.title = title
         if self.get(song.title) is None:
-            self[song.title] = song
             if sort_files:
                 new_path = self.path + filename
-                if new_path != path:
+                # A refused transfer leaves the song where it is
+                if new_path != path and self.transfers.add(src=path, dst=new_path, move=move):
+                    if not move:
+                        # The original stays where it is, so the song it belongs to must keep its path
+                        song = shallow_copy(song)
                     song.path = new_path
-                    if move:
-                        print("Moving", path, "to", new_path)
-                        shutil.move(src=path, dst=new_path)
-                    else:
-                        print("Copying", path, "to", new_path)
-                        shutil.copy(src=path, dst=new_path)
+            self[song.title] = song
 
         else:
-            print("Attempted to add duplicate song,", song.title, ';', song.album, ';', song.artist)
+            logger.debug(f"Attempted to add duplicate song, {song.title} ; {song.album} ; {song.artist}")
             if delete_duplicate:
-                print('Deleting duplicate file.')
-                os.remove(path)
+                delete_file(path)
 
     def show_songs(self, pad: int = 0):
         padding = ""
@@ -383,62 +1825,115 @@ class AlbumDictTree:
     def count_songs(self):
         return len(self.songs)
 
-    def compare(self, other: 'AlbumDictTree', copy: bool = False):
+    def compare(self, other: 'AlbumDictTree', copy: bool = False, transfers: TransferPlan = None):
         """
         Returns a new AlbumDictTree containing songs present in this album but missing in the other.
         :param other:
+        :param transfers: Plan to add the copies to; if None, the copies are made before returning.
         :return:
         """
         # sort_files is copy because, if we are copying, it needs to create/check for the destination folder's exisence.
-        missing_songs = AlbumDictTree(self.title, path=other.path, sort_files=copy)
+        missing_songs = AlbumDictTree(self.title, path=other.path, sort_files=copy, transfers=transfers)
         for song_name in self.songs:
             song = self[song_name]
-            print("\t\tSearching for song", song.title, "in", other.title)
+            logger.debug(f"\t\tSearching for song {song.title} in {other.title}")
             if other.get(song.title) is None:
-                print("\t\tSong not found. Adding to difference. Copy is", copy)
+                logger.debug(f"\t\tSong not found. Adding to difference. Copy is {copy}")
                 missing_songs.add_song(song, path=song.path, set_title=True, sort_files=copy, move=False)
             else:
-                print("\t\tSong found. Ignoring.")
+                logger.debug("\t\tSong found. Ignoring.")
+        if copy and transfers is None:
+            missing_songs.transfers.execute()
         return missing_songs
 
     def csv(self):
-        rows = []
-        for song in self.songs:
-            song = self.songs[song]
-            rows.append(song.csv())
-        return rows
+        return list(self.iter_csv())
+
+    def iter_csv(self, sort: bool = False):
+        for song in self.songs.values():
+            yield song.csv()
 
 
 class Song:
-    def __init__(self, path: str, title: str = "", album: str = "", artist: str = "", is_csv: bool = False):
+    __slots__ = ('title', 'path', 'filetype', 'album', 'artist', 'is_csv', 'size', 'core', '_tags')
+
+    def __init__(self, path: str, title: str = "", album: str = "", artist: str = "", is_csv: bool = False,
+                 tags: dict = None, size: int = None):
+        """
+        Only the core_tags are kept, as a tuple of their first values with repeated names interned; the full tag set is
+        read from the file again if the tags attribute is used.
+        :param tags: Tags already read from the file; if None, they are read now.
+        :param size: Size of the file in bytes, if known.
+        """
         self.title = str(title)
         self.path = path
-        self.filetype = get_filetype(self.path)
+        self.size = size
+        self.filetype = sys.intern(get_filetype(self.path))
         self.album = album
         self.artist = artist
         self.is_csv = is_csv
-        self.tags = self.get_tags()
+        if tags is None:
+            tags = read_tags(self.path, is_csv=self.is_csv)
+        self.core = tuple(self.first_value(tags.get(tag)) for tag in core_tags)
+        self._tags = None
+
+    @classmethod
+    def from_core(cls, path: str, core: tuple, filetype: str = None, is_csv: bool = False, size: int = None):
+        """
+        Creates a song from its core tag values, without reading the file or building a tag dict.
+        :param core: Values of the core_tags, in order, with None for those missing.
+        """
+        song = cls.__new__(cls)
+        song.title = ""
+        song.path = path
+        if filetype is None:
+            filetype = sys.intern(get_filetype(path))
+        song.filetype = filetype
+        song.album = ""
+        song.artist = ""
+        song.is_csv = is_csv
+        song.size = size
+        song.core = core
+        song._tags = None
+        return song
+
+    @classmethod
+    def from_columns(cls, path: str, title: str, album: str, artist: str, filetype: str, is_csv: bool, size: int):
+        """
+        Creates a song from already-known names, as stored in a ColumnarLibrary, without reading the file.
+        :param size: Size of the file in bytes, or -1 if unknown.
+        """
+        song = cls.from_core(path, core=(artist, None, album, title), filetype=filetype, is_csv=is_csv,
+                             size=None if size < 0 else size)
+        song.title = title
+        song.album = album
+        song.artist = artist
+        return song
+
+    @staticmethod
+    def first_value(values):
+        if values in empty_lists:
+            return None
+        return sys.intern(values[0])
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = self.get_tags()
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags
+
+    def get_tag(self, tag: str):
+        """
+        Returns the first value of one of the core_tags, or None if it is missing or empty.
+        """
+        return self.core[core_tags.index(tag)]
 
     def get_tags(self):
-        if self.is_csv:
-            # try:
-            with open(self.path, newline='', encoding="utf8") as csvfile:
-                reader = csv.DictReader(csvfile)
-
-                csv_row = reader.__next__()
-            tags = {'TITLE': [sanitise_html_encoding(csv_row['Title'])],
-                    'ALBUM': [sanitise_html_encoding(csv_row['Album'])],
-                    'ARTIST': [sanitise_html_encoding(csv_row['Artist'])],
-                    'ALBUMARTIST': [sanitise_html_encoding(csv_row['Artist'])]}
-            # except UnicodeDecodeError:
-            #     tags = {'TITLE': 'ERROR',
-            #             'ALBUM': 'ERROR',
-            #             'ARTIST': 'ERROR',
-            #             'ALBUMARTIST': 'ERROR'}
-            return tags
-        else:
-            file = tl.File(self.path)
-            return file.tags
+        return read_tags(self.path, is_csv=self.is_csv, full=True)
 
     def show(self, prefix: str = ''):
         print(prefix + self.title)
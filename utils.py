@@ -1,23 +1,131 @@
 from sys import platform
 import os
+import re
+import hashlib
+import html
+import logging
+import unicodedata
+
+# Configured along with the music module's logger by music.set_verbosity
+_logger = logging.getLogger(__name__)
+_logger.addHandler(logging.NullHandler())
+
+
+def walk_directories(path, recurse: bool = True, onerror=None):
+    """
+    Walks the directory tree under path with os.scandir, without recursion, yielding (directory, subdirectories, files)
+    for each directory only after all of its subdirectories have been yielded. subdirectories is a list of paths and
+    files a list of os.DirEntry, so their cached type information can be reused without another stat. Symbolic links
+    to directories are not followed, and are listed with the files, so that link loops cannot recurse forever.
+    :param onerror: Called with the OSError when a directory cannot be scanned (eg it was deleted during the walk), which
+    is then skipped; if None, the error is raised.
+    """
+    stack = [(path, None, None)]
+    while stack:
+        directory, subdirectories, files = stack.pop()
+        if files is not None:
+            yield directory, subdirectories, files
+            continue
+        subdirectories = []
+        files = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    else:
+                        files.append(entry)
+        except OSError as e:
+            if onerror is None:
+                raise
+            onerror(e)
+            continue
+        stack.append((directory, subdirectories, files))
+        if recurse:
+            stack.extend((d, None, None) for d in reversed(subdirectories))
+
+
+def walk_files(path, extensions=None, recurse: bool = True):
+    """
+    Yields an os.DirEntry for every file under path whose extension is in extensions (or every file, if extensions is
+    None), in the order of walk_directories.
+    """
+    for directory, subdirectories, files in walk_directories(path, recurse=recurse):
+        for entry in files:
+            if extensions is None or get_filetype(entry.name) in extensions:
+                yield entry
 
 
 def clear_empty_paths(path):
-    for next_path in filter(lambda d: os.path.isdir(path + "\\" + d), os.listdir(path)):
-        print(next_path)
-        next_path = path + "\\" + next_path
-        clear_empty_paths(next_path)
+    removed = set()
+    for directory, subdirectories, files in walk_directories(path):
+        if not files and all(d in removed for d in subdirectories):
+            _logger.debug(f"Attempting removal of {directory}")
+            os.rmdir(directory)
+            removed.add(directory)
+
+
+def file_hash(path, start: int = 0, stop: int = None, chunk_size: int = 1 << 20):
+    """
+    Hashes the bytes of a file between start and stop (the end of the file, if None), reading fixed-size chunks so that
+    memory use does not depend on the size of the file.
+    :return: The hex digest.
+    """
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as file:
+        file.seek(start)
+        remaining = stop - start if stop is not None else None
+        while remaining is None or remaining > 0:
+            if remaining is None:
+                chunk = file.read(chunk_size)
+            else:
+                chunk = file.read(min(chunk_size, remaining))
+                remaining -= len(chunk)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    if os.path.isdir(path):
-        if len(os.listdir(path)) == 0:
-            print("Attempting removal of", path)
-            os.removedirs(path)
+
+def delete_file(path):
+    _logger.debug(f"Deleting duplicate file {path}")
+    os.remove(path)
 
 
 def sanitise_html_encoding(string):
-    string = string.replace("&quot;", '"').replace("&#39;", "'").replace("&amp;", "&").replace("&lt;", "<")
-    string = string.replace("&gt;", ">")#.replace('â€“', "–").replace('â€¦', '…').replace('â€™', '’').replace('â€œ', '“')
-    return string
+    # A single pass over the string, which returns immediately when there is no '&' in it.
+    return html.unescape(string)#.replace('â€“', "–").replace('â€¦', '…').replace('â€™', '’').replace('â€œ', '“')
+
+
+# Bracketed or dashed suffixes that mark a remaster of the same recording, eg "(Remastered 2009)"; tags such as "(Live
+# Version)" or "(Mono)" are kept, as they mark a different recording.
+release_suffix = re.compile(r"\s*(?:[(\[][^()\[\]]*(?:remaster|deluxe)[^()\[\]]*[)\]]"
+                            r"|-\s*(?:\d{4}\s*)?(?:digital(?:ly)?\s*)?remaster.*)\s*$", re.IGNORECASE)
+# Not when the rest of the name is itself an article, as in "The The".
+leading_article = re.compile(r"^(?:the|a|an)\s+(?!(?:the|a|an)$)")
+trailing_article = re.compile(r",\s*(?:the|a|an)$")
+non_word = re.compile(r"[\W_]+")
+
+
+def normalise_name(string):
+    """
+    Reduces an artist, album or title to a form for matching: case, accents, punctuation, leading articles ("The
+    Beatles", "Beatles, The") and remaster suffixes ("(Remastered)", "- 2011 Remaster") are ignored.
+    """
+    string = unicodedata.normalize('NFKD', str(string).casefold())
+    string = ''.join(c for c in string if not unicodedata.combining(c))
+    previous = None
+    while previous != string:
+        previous = string
+        string = release_suffix.sub('', string)
+    string = trailing_article.sub('', string.strip())
+    # Before punctuation becomes spaces, so that "A-ha" keeps its "a".
+    string = leading_article.sub('', string).replace('&', ' and ')
+    return non_word.sub(' ', string).strip()
+
+
+def normalise_key(names):
+    return tuple(normalise_name(n) for n in names)
 
 
 def sanitise_path(path):
@@ -53,7 +161,7 @@ def get_filetype(path):
 def get_filename(path):
     pos = -1
     while abs(pos) <= len(path):
-        if path[pos] == '\\' and pos != -1:
+        if path[pos] in ('\\', os.sep) and pos != -1:
             return path[pos + 1:]
         pos = pos - 1
     return path